@@ -0,0 +1,48 @@
+from __future__ import absolute_import, division, print_function
+
+import queue
+import threading
+
+
+class BackgroundWorker:
+    """Process jobs in order in a daemon thread
+    Subclasses implement process(*job). The queue is bounded so that a slow worker holds the
+    producer back instead of piling up jobs in memory. An error raised by a job is raised again
+    by the next call to put or wait.
+    """
+    def __init__(self, max_queued):
+        self.queue = queue.Queue(max_queued)
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, *job):
+        """Queue a job, blocks while the queue is full
+        """
+        self.raise_error()
+        self.queue.put(job)
+
+    def wait(self):
+        """Block until all the queued jobs are processed
+        """
+        self.queue.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self.process(*job)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def process(self, *job):
+        raise NotImplementedError
@@ -0,0 +1,76 @@
+# benchmarks the training step in eager mode against --compile, at the fixed shapes of one training batch
+# all the training options apply, e.g.
+#   python benchmark_compile.py --data_path nyu_data/ --batch_size 8 --no_cuda
+
+import copy
+import time
+
+import numpy as np
+import torch
+
+from trainer import Trainer
+from options import MonodepthOptions
+from layers import MemoryMeter
+
+
+options = MonodepthOptions()
+options.parser.add_argument("--num_warmup_steps",
+                            type=int,
+                            help="number of steps run before the timing, the first one compiles",
+                            default=3)
+options.parser.add_argument("--num_timed_steps",
+                            type=int,
+                            help="number of timed steps",
+                            default=10)
+opts = options.parse()
+
+
+def train_step(trainer, inputs):
+    """Run one optimization step on 'inputs', as Trainer.run_epoch does without accumulation
+    """
+    trainer.model_optimizer.zero_grad()
+    with trainer.autocast():
+        outputs, losses = trainer.process_batch(dict(inputs), keep_outputs=False)
+    trainer.scaler.scale(losses["loss"]).backward()
+    trainer.scaler.step(trainer.model_optimizer)
+    trainer.scaler.update()
+
+
+def benchmark(opt, compile):
+    """Time the training steps of a trainer in eager or compiled mode, always on the same batch
+    Returns the duration of the first step, the median duration of the timed steps, the samples/s
+    and the memory saved for the backward pass (MB).
+    """
+    opt = copy.copy(opt)
+    opt.compile = compile
+
+    torch.manual_seed(0)
+    trainer = Trainer(opt)
+    trainer.set_train()
+    inputs = {key: ipt.to(trainer.device) for key, ipt in next(iter(trainer.train_loader)).items()}
+
+    durations = []
+    for _ in range(opt.num_warmup_steps + opt.num_timed_steps):
+        start_time = time.time()
+        train_step(trainer, inputs)
+        if trainer.device.type == "cuda":
+            torch.cuda.synchronize(trainer.device)
+        durations.append(time.time() - start_time)
+
+    memory = MemoryMeter(trainer.device)
+    with memory, trainer.autocast():
+        trainer.process_batch(dict(inputs), keep_outputs=False)
+        memory.record("step")
+
+    step_duration = np.median(durations[opt.num_warmup_steps:])
+    return [durations[0], step_duration, opt.batch_size / step_duration, memory.report["saved_memory/step"]]
+
+
+print("-> Benchmarking eager and compiled training steps, batch {} at {}x{}".format(
+    opts.batch_size, opts.height, opts.width))
+results = {mode: benchmark(opts, mode == "compiled") for mode in ["eager", "compiled"]}
+
+print("\n  " + ("{:>10} | " + "{:>12} | " * 4).format(
+    "mode", "first step s", "step s", "samples/s", "saved MB"))
+for mode, result in results.items():
+    print("  " + ("{:>10} | " + "{:12.3f} | " * 4).format(mode, *result))
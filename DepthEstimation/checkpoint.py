@@ -0,0 +1,72 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import torch
+
+from background import BackgroundWorker
+
+
+def map_tensors(state, fn, types=torch.Tensor):
+    """Apply 'fn' to all the objects of type 'types' in a (nested) state dict
+    """
+    if isinstance(state, types):
+        return fn(state)
+    if isinstance(state, dict):
+        return type(state)((k, map_tensors(v, fn, types)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(map_tensors(v, fn, types) for v in state)
+    return state
+
+
+def state_to_cpu(state):
+    """Copy all the tensors of a (nested) state dict to the CPU
+    The copies are a snapshot, training can go on updating the original tensors.
+    """
+    return map_tensors(state, lambda t: t.detach().to("cpu", copy=True))
+
+
+def load_weights(path, names, map_location=None):
+    """Load the state dicts of the models 'names' (and "adam" for the optimizer) from 'path'
+    'path' is either a checkpoint file written by CheckpointWriter or a folder holding one .pth
+    file per model. Names missing from the checkpoint are left out of the returned dictionary.
+    """
+    if os.path.isfile(path):
+        checkpoint = torch.load(path, map_location=map_location)
+        return {n: checkpoint[n] for n in names if n in checkpoint}
+
+    weights = {}
+    for n in names:
+        model_path = os.path.join(path, "{}.pth".format(n))
+        if os.path.isfile(model_path):
+            weights[n] = torch.load(model_path, map_location=map_location)
+    return weights
+
+
+class CheckpointWriter(BackgroundWorker):
+    """Write checkpoints in a background thread
+    A checkpoint is a single file holding the state dicts of all the models and of the optimizer.
+    It is written to a temporary file which is then renamed, so that an interrupted write never
+    leaves a partial checkpoint behind. Each queued checkpoint is a full copy of the weights, so
+    at most max_queued of them wait to be written.
+    """
+    def __init__(self, max_queued=1):
+        super(CheckpointWriter, self).__init__(max_queued)
+
+    def save(self, state, path):
+        """Queue 'state' to be written to 'path', its tensors must already be snapshot to the CPU
+        """
+        self.put(state, path)
+
+    def process(self, state, path):
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
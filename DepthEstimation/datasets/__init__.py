@@ -1 +1,2 @@
-from .nyu_dataset import NYUDataset
\ No newline at end of file
+from .nyu_dataset import NYUDataset
+from .samplers import ResumableSampler
@@ -10,12 +10,15 @@ import os
 import random
 import numpy as np
 import copy
+import warnings
 from PIL import Image  # using pillow-simd for increased speed
 
 import torch
 import torch.utils.data as data
 from torchvision import transforms
 
+from .struct_index import build_struct_index, struct_index_key, sample_keysets
+
 
 def pil_loader(path):
     # open path as file to avoid ResourceWarning
@@ -37,6 +40,10 @@ class MonoDataset(data.Dataset):
         num_scales
         is_train
         img_ext
+        lazy_structure_extraction
+        structure_cache_dir
+        plane_extractor
+        line_extractor
     """
     def __init__(self,
                  data_path,
@@ -51,7 +58,11 @@ class MonoDataset(data.Dataset):
                  num_plane_keysets=512,
                  return_line=False,
                  num_line_keysets=128,
-                 img_ext='.jpg'):
+                 img_ext='.jpg',
+                 lazy_structure_extraction=False,
+                 structure_cache_dir=None,
+                 plane_extractor="felzenszwalb",
+                 line_extractor="lsd"):
         super(MonoDataset, self).__init__()
 
         self.data_path = data_path
@@ -67,6 +78,12 @@ class MonoDataset(data.Dataset):
         self.is_test = is_test
         self.img_ext = img_ext
 
+        # extract missing plane/line label maps on first access and cache them
+        self.lazy_structure_extraction = lazy_structure_extraction
+        self.structure_cache_dir = structure_cache_dir if structure_cache_dir is not None else data_path
+        self.plane_extractor = plane_extractor
+        self.line_extractor = line_extractor
+
         self.loader = pil_loader
         self.to_tensor = transforms.ToTensor()
 
@@ -104,13 +121,54 @@ class MonoDataset(data.Dataset):
                 self.pl_resize[i] = transforms.Resize((self.height // s, self.width // s),
                                                       interpolation=Image.NEAREST)
 
-    def preprocess(self, inputs, color_aug):
+        # precomputed CSR indices of the structure pixels (see preprocess/build_struct_index.py)
+        self.load_plane_index = self.load_plane and self.check_struct_index("plane")
+        self.load_line_index = self.load_line and self.check_struct_index("line")
+
+    def check_struct_index(self, struct):
+        """Check whether precomputed structure indices exist for the training resolution
+        Only the first frame is probed, the index of every frame is checked again when it is loaded.
+        """
+        line = self.filenames[0].split()
+        folder = line[0]
+        frame_index = int(line[1]) if len(line) >= 2 else 0
+        side = line[2] if len(line) == 3 else None
+
+        return self.load_struct_index(struct, folder, frame_index, side) is not None
+
+    def load_struct_index(self, struct, folder, frame_index, side):
+        """Load the precomputed structure index of a frame, or None if the frame has none
+        An index built for another resolution or with fewer scales is ignored with a warning, the
+        keysets of the frame are then sampled from an index built on the fly.
+        """
+        struct_index = self.get_struct_index(struct, folder, frame_index, side)
+        if struct_index is None:
+            return None
+
+        keys = [struct_index_key(name, i, flip)
+                for name in ["offsets", "indices"] for i in range(self.num_scales) for flip in [False, True]]
+        if int(struct_index["height"]) != self.height or int(struct_index["width"]) != self.width or \
+                any(k not in struct_index for k in keys):
+            warnings.warn("ignoring the {} index of {} {}, it was not built for {}x{} with {} scales".format(
+                struct, folder, frame_index, self.height, self.width, self.num_scales))
+            return None
+
+        return struct_index
+
+    def preprocess(self, inputs, color_aug, struct_index=None, do_flip=False):
         """Resize colour images to the required scales and augment if required
 
         We create the color_aug object in advance and apply the same augmentation to all
         images in this item. This ensures that all images input to the pose network receive the
         same augmentation.
+
+        Plane and line keysets are drawn from a CSR index of the pixels of each label. It is
+        either taken from 'struct_index' (precomputed offline) or built once per scale from
+        the resized label map.
         """
+        if struct_index is None:
+            struct_index = {}
+
         for k in list(inputs):
             frame = inputs[k]
             if "color" in k:
@@ -150,29 +208,13 @@ class MonoDataset(data.Dataset):
 
                 keyset_samples = 4 if n == "plane" else 3
 
-                f = f.flatten()
-                num_struct_pixels = np.sum(f > 0)
-                num_struct = f.max()
-
-                keysets = []
-                acc_num = 0
-                for j in range(num_struct):
-                    pixels_j = np.sum(f == j+1)
-                    num_j = int(np.ceil(num_struct_keysets//2**i*pixels_j/num_struct_pixels))
-                    acc_num += num_j
-
-                    inx_j = np.argwhere(f == j+1)
-                    keyset_j = inx_j[np.random.randint(inx_j.shape[0], size=num_j*keyset_samples)]
-                    keyset_j = np.reshape(keyset_j, (keyset_samples, num_j))
-                    if keyset_j.size > 0:
-                      keysets.append(keyset_j)
-                
-                if len(keysets):
-                    keysets = np.concatenate(keysets, axis=1)
-                    keysets = keysets[:, np.random.randint(keysets.shape[1], size=num_struct_keysets//2**i)]
+                if n in struct_index:
+                    offsets = struct_index[n][struct_index_key("offsets", i, do_flip)]
+                    indices = struct_index[n][struct_index_key("indices", i, do_flip)]
                 else:
-                    # no a keyset found (no detected planes or lines)
-                    keysets = np.zeros((keyset_samples, num_struct_keysets//2**i), dtype=np.int)
+                    offsets, indices = build_struct_index(f)
+
+                keysets = sample_keysets(offsets, indices, num_struct_keysets // 2 ** i, keyset_samples)
 
                 inputs[(n + "_keysets", im, i)] = torch.from_numpy(keysets).long()
 
@@ -260,13 +302,23 @@ class MonoDataset(data.Dataset):
             inputs["depth_gt"] = np.expand_dims(depth_gt, 0)
             inputs["depth_gt"] = torch.from_numpy(inputs["depth_gt"].astype(np.float32))
 
+        struct_index = {}
+
         if self.load_plane:
             inputs[("plane", 0, -1)] = self.get_plane(folder, frame_index, side, do_flip)
+            plane_index = self.load_struct_index("plane", folder, frame_index, side) \
+                if self.load_plane_index else None
+            if plane_index is not None:
+                struct_index["plane"] = plane_index
 
         if self.load_line:
             inputs[("line", 0, -1)] = self.get_line(folder, frame_index, side, do_flip)
+            line_index = self.load_struct_index("line", folder, frame_index, side) \
+                if self.load_line_index else None
+            if line_index is not None:
+                struct_index["line"] = line_index
 
-        self.preprocess(inputs, color_aug)
+        self.preprocess(inputs, color_aug, struct_index, do_flip)
 
         for i in self.frame_idxs:
             if self.is_test:
@@ -310,3 +362,6 @@ class MonoDataset(data.Dataset):
 
     def get_line(self, folder, frame_index, side, do_flip):
         raise NotImplementedError
+
+    def get_struct_index(self, struct, folder, frame_index, side):
+        return None
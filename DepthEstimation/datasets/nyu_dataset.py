@@ -6,6 +6,7 @@ import PIL.Image as pil
 import cv2
 
 from .mono_dataset import MonoDataset
+from .structures import extract_superpixel, extract_lineseg, save_label_map
 
 
 class NYUDataset(MonoDataset):
@@ -47,6 +48,9 @@ class NYUDataset(MonoDataset):
         return os.path.isfile(depth_filename)
 
     def check_plane(self):
+        if self.lazy_structure_extraction:
+            return True
+
         line = self.filenames[0].split()
         scene_name = line[0]
         frame_index = line[1]
@@ -58,6 +62,9 @@ class NYUDataset(MonoDataset):
         return os.path.isfile(plane_filename)
 
     def check_line(self):
+        if self.lazy_structure_extraction:
+            return True
+
         line = self.filenames[0].split()
         scene_name = line[0]
         frame_index = line[1]
@@ -112,7 +119,7 @@ class NYUDataset(MonoDataset):
         return depth_gt
 
     def get_plane(self, folder, frame_index, side, do_flip):
-        plane = pil.open(self.get_plane_path(folder, frame_index, side))
+        plane = pil.open(self.get_struct_label_path("plane", folder, frame_index, side))
 
         plane = plane.crop((self.edge_crop, self.edge_crop, 640-self.edge_crop, 480-self.edge_crop))
 
@@ -131,7 +138,7 @@ class NYUDataset(MonoDataset):
         return plane_path
 
     def get_line(self, folder, frame_index, side, do_flip):
-        line = pil.open(self.get_line_path(folder, frame_index, side))
+        line = pil.open(self.get_struct_label_path("line", folder, frame_index, side))
 
         line = line.crop((self.edge_crop, self.edge_crop, 640-self.edge_crop, 480-self.edge_crop))
 
@@ -149,6 +156,53 @@ class NYUDataset(MonoDataset):
                 self.data_path, folder, str(frame_index) + "_line.png")
         return line_path
 
+    def get_struct_label_path(self, struct, folder, frame_index, side):
+        """Return the path of a plane/line label map
+
+        With lazy structure extraction, label maps missing from the data path are
+        extracted from the colour image on first access and cached, so later epochs
+        read them like the outputs of the offline preprocessing. The cached file is
+        named after the extractor backend, so that changing the backend extracts them again.
+        """
+        if struct == "plane":
+            label_path = self.get_plane_path(folder, frame_index, side)
+        else:
+            label_path = self.get_line_path(folder, frame_index, side)
+
+        if not self.lazy_structure_extraction or os.path.isfile(label_path):
+            return label_path
+
+        extractor = self.plane_extractor if struct == "plane" else self.line_extractor
+        cache_path, ext = os.path.splitext(os.path.relpath(label_path, self.data_path))
+        cache_path = os.path.join(self.structure_cache_dir, "{}_{}{}".format(cache_path, extractor, ext))
+        if not os.path.isfile(cache_path):
+            image_path = self.get_image_path(folder, frame_index, side)
+            if struct == "plane":
+                label_map = extract_superpixel(image_path, self.plane_extractor)
+            else:
+                label_map = extract_lineseg(image_path, self.line_extractor)
+            save_label_map(cache_path, label_map)
+
+        return cache_path
+
+    def get_struct_index(self, struct, folder, frame_index, side):
+        index_path = self.get_struct_index_path(struct, folder, frame_index, side)
+        if not os.path.isfile(index_path):
+            return None
+
+        with np.load(index_path) as struct_index:
+            return dict(struct_index)
+
+    def get_struct_index_path(self, struct, folder, frame_index, side):
+        suffix = "_seg_index.npz" if struct == "plane" else "_line_index.npz"
+        if self.is_test:
+            index_path = os.path.join(
+                self.data_path, folder, "{:05d}".format(frame_index) + suffix)
+        else:
+            index_path = os.path.join(
+                self.data_path, folder, str(frame_index) + suffix)
+        return index_path
+
     def get_norm_pix_coords(self):
         w, h = self.full_res_shape
 
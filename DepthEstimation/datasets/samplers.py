@@ -0,0 +1,43 @@
+from __future__ import absolute_import, division, print_function
+
+from torch.utils.data import DistributedSampler
+
+
+class ResumableSampler(DistributedSampler):
+    """Shuffling sampler that can resume in the middle of an epoch
+    As with the DistributedSampler, each process gets its share of an order drawn from the seed
+    and the epoch. state_dict records this order along with the number of samples already used.
+    """
+    def __init__(self, dataset, num_replicas=1, rank=0, seed=0, drop_last=True):
+        super(ResumableSampler, self).__init__(
+            dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed, drop_last=drop_last)
+
+        self.indices = None
+        self.offset = 0
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.indices = None
+            self.offset = 0
+
+    def __iter__(self):
+        if self.indices is None:
+            self.indices = list(super(ResumableSampler, self).__iter__())
+        return iter(self.indices[self.offset:])
+
+    def __len__(self):
+        return self.num_samples - self.offset
+
+    def state_dict(self, num_used):
+        """State after 'num_used' samples of the current iteration
+        """
+        if self.indices is None:
+            self.indices = list(super(ResumableSampler, self).__iter__())
+        return {"epoch": self.epoch, "seed": self.seed, "indices": self.indices, "offset": self.offset + num_used}
+
+    def load_state_dict(self, state):
+        self.epoch = state["epoch"]
+        self.seed = state["seed"]
+        self.indices = state["indices"]
+        self.offset = state["offset"]
@@ -0,0 +1,69 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+from PIL import Image
+
+
+def build_struct_index(label_map):
+    """Build a CSR index of the pixels belonging to each plane/line label
+
+    The flat pixel indices of label j + 1 are indices[offsets[j]:offsets[j + 1]].
+    Label 0 marks pixels without a structure and is not indexed.
+    """
+    f = np.asarray(label_map).ravel().astype(np.int64)
+    counts = np.bincount(f, minlength=1)
+
+    order = np.argsort(f, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(counts[1:])])
+    indices = order[counts[0]:]
+
+    return offsets.astype(np.int64), indices.astype(np.int32)
+
+
+def build_struct_index_pyramid(label_image, height, width, num_scales):
+    """Build the CSR index of a (cropped) label image for every training scale
+
+    The label image is resized with nearest neighbour interpolation exactly like
+    MonoDataset does (each scale from the previous one), so the indices address
+    pixels at the training resolution. Nearest neighbour resizing does not commute
+    with flipping, hence the horizontally flipped label image is indexed as well.
+    The result can be stored with np.savez_compressed and read back by MonoDataset.
+    """
+    struct_index = {"height": np.array(height), "width": np.array(width)}
+    for flip in [False, True]:
+        label_i = label_image.transpose(Image.FLIP_LEFT_RIGHT) if flip else label_image
+        for i in range(num_scales):
+            s = 2 ** i
+            label_i = label_i.resize((width // s, height // s), Image.NEAREST)
+            offsets, indices = build_struct_index(np.array(label_i))
+            struct_index[struct_index_key("offsets", i, flip)] = offsets
+            struct_index[struct_index_key("indices", i, flip)] = indices
+    return struct_index
+
+
+def struct_index_key(name, scale, flip):
+    return "{}{}_{}".format(name, "_flip" if flip else "", scale)
+
+
+def sample_keysets(offsets, indices, num_keysets, keyset_samples):
+    """Draw keysets of pixels sharing a plane/line label from a CSR index
+
+    Labels are chosen proportionally to their number of pixels and the pixels of a
+    keyset are drawn uniformly from its label, so the cost only depends on the
+    number of samples. Returns an array of shape (keyset_samples, num_keysets).
+    """
+    counts = np.diff(offsets)
+    num_struct_pixels = counts.sum()
+
+    if num_struct_pixels == 0:
+        # no a keyset found (no detected planes or lines)
+        return np.zeros((keyset_samples, num_keysets), dtype=np.int64)
+
+    num_per_struct = np.ceil(num_keysets * counts / num_struct_pixels).astype(np.int64)
+    keyset_labels = np.repeat(np.arange(counts.shape[0]), num_per_struct)
+    keyset_labels = keyset_labels[np.random.randint(keyset_labels.shape[0], size=num_keysets)]
+
+    picks = offsets[keyset_labels] + np.random.randint(counts[keyset_labels],
+                                                       size=(keyset_samples, num_keysets))
+
+    return indices[picks].astype(np.int64)
@@ -0,0 +1,147 @@
+# adapted from https://github.com/svip-lab/Indoor-SfMLearner/blob/master/extract_superpixel.py
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import tempfile
+from functools import partial
+
+import numpy as np
+import cv2
+from skimage.segmentation import felzenszwalb, slic
+from skimage.util import img_as_float
+
+
+CROP = 16
+
+
+def felzenszwalb_segments(image, size=(384, 288), scale=100, sigma=0.5, min_size=50):
+    """Felzenszwalb superpixels of an image resized to 'size'
+    """
+    resize_image = img_as_float(cv2.resize(image, size))
+    return felzenszwalb(resize_image, scale=scale, sigma=sigma, min_size=min_size)
+
+
+def slic_segments(image, size=(384, 288), n_segments=100, compactness=10):
+    """SLIC superpixels of an image resized to 'size', with a fixed number of segments
+    """
+    resize_image = img_as_float(cv2.resize(image, size))
+    # SLIC labels start at 0, which filter_segments treats as background
+    return slic(resize_image, n_segments=n_segments, compactness=compactness) + 1
+
+
+def filter_segments(segment, min_pixels):
+    """Relabel the segments larger than 'min_pixels' as 1..n and set the others to 0
+    """
+    counts = np.bincount(segment.ravel())
+    keep = counts > min_pixels
+    keep[0] = False
+    new_labels = np.cumsum(keep) * keep
+    return new_labels[segment]
+
+
+def lsd_lines(image, scale=1):
+    """Line segments detected by OpenCV's LSD on an image downscaled by 'scale'
+    """
+    lsd = cv2.createLineSegmentDetector(0, scale)
+    lines = lsd.detect(image)[0]
+    if lines is None:
+        # textureless image, no line segment detected
+        return np.zeros([0, 4], dtype=np.float32)
+    return lines.reshape(-1, 4)
+
+
+# extractor backends, each with the minimal number of pixels (at its working resolution)
+# a superpixel needs to be kept as a plane
+PLANE_EXTRACTORS = {
+    "felzenszwalb": (felzenszwalb_segments, 1000),
+    "felzenszwalb_lowres": (partial(felzenszwalb_segments, size=(192, 144), min_size=12), 250),
+    "slic": (slic_segments, 1000),
+    "slic_lowres": (partial(slic_segments, size=(192, 144)), 250),
+}
+
+LINE_EXTRACTORS = {
+    "lsd": partial(lsd_lines, scale=1),
+    "lsd_0.8": partial(lsd_lines, scale=0.8),
+    "lsd_0.5": partial(lsd_lines, scale=0.5),
+}
+
+
+def extract_superpixel(filename, backend="felzenszwalb"):
+    image = cv2.imread(filename)
+    h, w, c = image.shape
+
+    corp_image = image[CROP:-CROP, CROP:-CROP, :]
+
+    extract_segments, min_pixels = PLANE_EXTRACTORS[backend]
+    segment = filter_segments(extract_segments(corp_image), min_pixels)
+
+    segment = cv2.resize(segment, (w - 2 * CROP, h - 2 * CROP), interpolation=cv2.INTER_NEAREST)
+
+    ext_seg = np.zeros([h, w], dtype=np.int64)
+    ext_seg[CROP:-CROP, CROP:-CROP] = segment
+
+    return ext_seg
+
+
+def extract_lineseg(filename, backend="lsd"):
+    image = cv2.imread(filename, 1)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    h, w = image.shape
+
+    corp_image = image[CROP:-CROP, CROP:-CROP]
+
+    lines = LINE_EXTRACTORS[backend](corp_image)
+    lengths = np.sqrt((lines[:, 0] - lines[:, 2]) ** 2 + (lines[:, 1] - lines[:, 3]) ** 2)
+    arr1inds = lengths.argsort()[::-1]
+    lengths = lengths[arr1inds[::-1]]
+    lines = lines[arr1inds[::-1]]
+    lines = lines[lengths > np.sqrt(corp_image.shape[0]**2+corp_image.shape[1]**2) / 10]
+    lines = lines[:min(lines.shape[0], 255)]
+
+    line_seg = np.zeros([h, w], dtype=np.int64)
+
+    n = 1
+    for k in range(lines.shape[0]):
+        x1, y1, x2, y2 = lines[k]
+
+        xmin = max(0, int(np.floor(min(x1, x2))))
+        xmax = min(int(np.ceil(max(x1, x2))), w - 2 * CROP)
+
+        ymin = max(0, int(np.floor(min(y1, y2))))
+        ymax = min(int(np.floor(max(y1, y2))), h - 2 * CROP)
+
+        # distance of every pixel of the bounding box to the line
+        i, j = np.meshgrid(np.arange(xmin, xmax), np.arange(ymin, ymax), indexing="ij")
+        vec1_x, vec1_y = x1 - i, y1 - j
+        vec2_x, vec2_y = x2 - i, y2 - j
+        distance = np.abs(vec1_x * vec2_y - vec1_y * vec2_x) / np.linalg.norm(lines[k, :2] - lines[k, 2:])
+        points = distance < 1
+
+        if points.sum() < 3:
+            continue
+        else:
+            line_seg[CROP + j[points], CROP + i[points]] = n
+            n += 1
+
+    return line_seg
+
+
+def save_label_map(path, label_map):
+    """Atomically write a plane/line label map as an 8-bit png
+
+    The map is written to a temporary file next to 'path' and renamed, so concurrent
+    data loader workers never read a partially written file.
+    """
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(suffix=".png", dir=folder)
+    os.close(fd)
+    try:
+        cv2.imwrite(tmp_path, label_map.astype(np.uint8))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
@@ -9,6 +9,7 @@ from torch.utils.data import DataLoader
 import torch.nn as nn
 
 from layers import disp_to_depth
+from checkpoint import load_weights
 from utils import readlines
 from options import MonodepthOptions
 import datasets
@@ -53,6 +54,13 @@ def batch_post_process_disparity(l_disp, r_disp):
     return r_mask * l_disp + l_mask * r_disp + (1.0 - l_mask - r_mask) * m_disp
 
 
+def weights_output_path(opt, filename):
+    """Path of an output file, saved in the weights folder or next to the checkpoint file"""
+    if os.path.isdir(opt.load_weights_folder):
+        return os.path.join(opt.load_weights_folder, filename)
+    return "{}_{}".format(os.path.splitext(opt.load_weights_folder)[0], filename)
+
+
 def evaluate(opt):
     """Evaluates a pretrained model using a specified test set"""
     MIN_DEPTH = 1e-2
@@ -62,18 +70,15 @@ def evaluate(opt):
 
         opt.load_weights_folder = os.path.expanduser(opt.load_weights_folder)
 
-        assert os.path.isdir(opt.load_weights_folder), \
-            "Cannot find a folder at {}".format(opt.load_weights_folder)
+        assert os.path.exists(opt.load_weights_folder), \
+            "Cannot find {}".format(opt.load_weights_folder)
 
         print("-> Loading weights from {}".format(opt.load_weights_folder))
 
         filenames = readlines(os.path.join(splits_dir, opt.eval_split, "test_files.txt"))
-        encoder_path = os.path.join(opt.load_weights_folder, "encoder.pth")
-        decoder_path = os.path.join(opt.load_weights_folder, "depth.pth")
-        scalenet_path = os.path.join(opt.load_weights_folder, "scalenet.pth")
-        regression_path = os.path.join(opt.load_weights_folder, "regression.pth")
+        weights = load_weights(opt.load_weights_folder, ["encoder", "depth", "scalenet", "regression"])
 
-        encoder_dict = torch.load(encoder_path)
+        encoder_dict = weights["encoder"]
 
         dataset = datasets.NYUDataset(opt.data_path, filenames, encoder_dict['height'], encoder_dict['width'],
                                       [0], 1, is_test=True, return_plane=True, num_plane_keysets=0,
@@ -93,11 +98,11 @@ def evaluate(opt):
         encoder.load_state_dict({k: v for k, v in encoder_dict.items() if k in model_dict})
 
         model_dict = depth_decoder.state_dict()
-        decoder_dict = torch.load(decoder_path)
+        decoder_dict = weights["depth"]
         depth_decoder.load_state_dict({k: v for k, v in decoder_dict.items() if k in model_dict})
         
-        scalenet.load_state_dict(torch.load(scalenet_path))
-        regression_heads.load_state_dict(torch.load(regression_path))
+        scalenet.load_state_dict(weights["scalenet"])
+        regression_heads.load_state_dict(weights["regression"])
         
         encoder.cuda()
         encoder.eval()
@@ -142,36 +147,9 @@ def evaluate(opt):
                 max_depth = torch.mean(torch.stack(scale_predictions), dim=0)
                 global_depth.append(max_depth.cpu().numpy())
                 output = depth_decoder(features, norm_pix_coords)
-                
-                 
-                all_pred_disps = []
-
-                for i in range(max_depth.size(0)):
-                    # 获取当前图像的 disp 和 global_depth
-                    disp_i = output[("disp", 0)][i:i+1]  # 获取当前图像的 disp (1, H, W)
-                    max_depth_i = max_depth[i].item()  # 将张量转变为标量
-
-                    # 计算深度
-                    pred_disp_i, _ = disp_to_depth(disp_i, opt.min_depth, max_depth_i)
 
-                    # 确保 pred_disp_i 是 Tensor 类型
-                    if not isinstance(pred_disp_i, torch.Tensor):
-                        pred_disp_i = torch.tensor(pred_disp_i)
-
-                    # 调整 pred_disp_i 的尺寸，确保其形状为 (1, H, W)
-                    pred_disp_i = pred_disp_i.view(1, *pred_disp_i.shape[1:])
-
-                    # 收集所有 pred_disp
-                    all_pred_disps.append(pred_disp_i)
-
-                # 将所有 pred_disp 合并成一个 Tensor
-                pred_disp = torch.cat(all_pred_disps, dim=0)
-                
+                pred_disp, _ = disp_to_depth(output[("disp", 0)], opt.min_depth, max_depth)
                 pred_disp = pred_disp.cpu()[:, 0].numpy()
-                
-               #Adjust the disparity using max_depth
-                # pred_disp, _ = disp_to_depth(output[("disp", 0)], opt.min_depth, max_depth)
-                # pred_disp = pred_disp.cpu()[:, 0].numpy()
 
                 if opt.post_process:
                     N = pred_disp.shape[0] // 2
@@ -214,8 +192,7 @@ def evaluate(opt):
         pred_disps = np.load(opt.ext_disp_to_eval)
 
     if opt.save_pred_disps:
-        output_path = os.path.join(
-            opt.load_weights_folder, "disps_{}_split.npy".format(opt.eval_split))
+        output_path = weights_output_path(opt, "disps_{}_split.npy".format(opt.eval_split))
         print("-> Saving predicted disparities to ", output_path)
         np.save(output_path, pred_disps)
 
@@ -263,7 +240,7 @@ def evaluate(opt):
         errors.append(compute_errors(mask_gt_depth, mask_pred_depth))
 
     mean_errors = np.array(errors).mean(0)
-    result_path = os.path.join(opt.load_weights_folder, "result_{}_split.txt".format(opt.eval_split))
+    result_path = weights_output_path(opt, "result_{}_split.txt".format(opt.eval_split))
     f = open(result_path, 'w+')
 
     if not opt.disable_median_scaling:
@@ -0,0 +1,82 @@
+from __future__ import absolute_import, division, print_function
+
+import functools
+
+import torch
+
+
+def full_precision(fn):
+    """Run 'fn' in float32 with autocast disabled, its floating point tensor arguments are cast
+    to float32. Used for the numerically sensitive parts of the mixed-precision training.
+    """
+    def to_float(x):
+        return x.float() if torch.is_tensor(x) and x.is_floating_point() else x
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args = [to_float(x) for x in args]
+        kwargs = {k: to_float(x) for k, x in kwargs.items()}
+        device_type = next((x.device.type for x in args if torch.is_tensor(x)), "cpu")
+        with torch.autocast(device_type, enabled=False):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def axisangle_to_rotation(axisangle):
+    """Convert axis-angle vectors (..., 3) into rotation matrices (..., 3, 3)
+    Closed-form exponential map (Rodrigues' formula), vectorized over all leading dimensions.
+    """
+    angle = torch.norm(axisangle, 2, -1, True)
+    axis = axisangle / (angle + 1e-7)
+
+    ca = torch.cos(angle).unsqueeze(-1)
+    sa = torch.sin(angle).unsqueeze(-1)
+
+    x, y, z = axis.unbind(-1)
+    zeros = torch.zeros_like(x)
+    cross = torch.stack([zeros, -z, y,
+                         z, zeros, -x,
+                         -y, x, zeros], -1).view(*axis.shape[:-1], 3, 3)
+    outer = axis.unsqueeze(-1) * axis.unsqueeze(-2)
+    eye = torch.eye(3, device=axisangle.device, dtype=axisangle.dtype)
+
+    return ca * eye + sa * cross + (1 - ca) * outer
+
+
+@full_precision
+def pose_from_axisangle(axisangle, translation, invert=False):
+    """Convert axis-angle rotations and translations (..., 3) into 4x4 transformations (..., 4, 4)
+    'invert' is a bool, or a boolean tensor broadcastable to the leading dimensions selecting
+    which transformations are inverted. The result is written into a single preallocated tensor.
+    """
+    invert = torch.as_tensor(invert, device=axisangle.device)
+
+    # the inverse rotation is the rotation of the opposite axis-angle
+    sign = 1 - 2 * invert.to(axisangle.dtype)
+    R = axisangle_to_rotation(axisangle * sign.unsqueeze(-1))
+
+    t = translation.unsqueeze(-1)
+    t = torch.where(invert.unsqueeze(-1).unsqueeze(-1), -torch.matmul(R, t), t)
+
+    M = axisangle.new_zeros(*R.shape[:-2], 4, 4)
+    M[..., :3, :3] = R
+    M[..., :3, 3:] = t
+    M[..., 3, 3] = 1
+
+    return M
+
+
+@full_precision
+def accumulate_poses(T, dim=0):
+    """Chain 4x4 transformations along 'dim': returns T_0, T_0 @ T_1, T_0 @ T_1 @ T_2, ...
+    The prefix products are computed with log2(n) batched matrix products.
+    """
+    T = T.movedim(dim, 0)
+
+    offset = 1
+    while offset < T.shape[0]:
+        T = torch.cat([T[:offset], torch.matmul(T[:-offset], T[offset:])])
+        offset *= 2
+
+    return T.movedim(0, dim)
@@ -12,6 +12,7 @@ from torchvision import transforms
 
 import networks
 from layers import disp_to_depth
+from checkpoint import load_weights
 import torch.nn as nn
 
 def parse_args():
@@ -32,13 +33,10 @@ def parse_args():
 def prepare_model_for_test(args, device):
     model_path = args.load_weights_folder
     print("-> Loading model from ", model_path)
-    encoder_path = os.path.join(model_path, "encoder.pth")
-    decoder_path = os.path.join(model_path, "depth.pth")
-    scalenet_path = os.path.join(model_path, "scalenet.pth")
-    regression_path = os.path.join(model_path, "regression.pth")
-    
-    encoder_dict = torch.load(encoder_path, map_location=device)
-    decoder_dict = torch.load(decoder_path, map_location=device)
+    weights = load_weights(model_path, ["encoder", "depth", "scalenet", "regression"], map_location=device)
+
+    encoder_dict = weights["encoder"]
+    decoder_dict = weights["depth"]
     
     encoder = networks.ResnetEncoder(18, False)
     decoder = networks.DepthDecoder(
@@ -52,8 +50,8 @@ def prepare_model_for_test(args, device):
 
     encoder.load_state_dict({k: v for k, v in encoder_dict.items() if k in encoder.state_dict()})
     decoder.load_state_dict(decoder_dict)
-    scalenet.load_state_dict(torch.load(scalenet_path))
-    regression_heads.load_state_dict(torch.load(regression_path))
+    scalenet.load_state_dict(weights["scalenet"])
+    regression_heads.load_state_dict(weights["regression"])
     
     encoder = encoder.to(device).eval()
     decoder = decoder.to(device).eval()
@@ -6,19 +6,28 @@
 
 from __future__ import absolute_import, division, print_function
 
+import contextlib
+
 import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from torchvision.models.resnet import conv1x1
 
+from geometry import pose_from_axisangle, full_precision
+
 
+@full_precision
 def disp_to_depth(disp, min_depth, max_depth):
     """Convert network's disparity output into depth prediction
     The formula for this conversion is given in the 'additional considerations'
     section of the paper.
+    max_depth is either a scalar or a tensor holding one max depth per sample.
     """
+    if torch.is_tensor(max_depth) and max_depth.dim() > 0:
+        max_depth = max_depth.view(-1, *([1] * (disp.dim() - 1)))
 
     min_disp = 1 / max_depth
     max_disp = 1 / min_depth
@@ -36,21 +45,7 @@ def coeff_to_normal(coeff):
 def transformation_from_parameters(axisangle, translation, invert=False):
     """Convert the network's (axisangle, translation) output into a 4x4 matrix
     """
-    R = rot_from_axisangle(axisangle)
-    t = translation.clone()
-
-    if invert:
-        R = R.transpose(1, 2)
-        t *= -1
-
-    T = get_translation_matrix(t)
-
-    if invert:
-        M = torch.matmul(R, T)
-    else:
-        M = torch.matmul(T, R)
-
-    return M
+    return pose_from_axisangle(axisangle[:, 0], translation[:, 0], invert)
 
 
 def get_translation_matrix(translation_vector):
@@ -71,44 +66,9 @@ def get_translation_matrix(translation_vector):
 
 def rot_from_axisangle(vec):
     """Convert an axisangle rotation into a 4x4 transformation matrix
-    (adapted from https://github.com/Wallacoloo/printipi)
     Input 'vec' has to be Bx1x3
     """
-    angle = torch.norm(vec, 2, 2, True)
-    axis = vec / (angle + 1e-7)
-
-    ca = torch.cos(angle)
-    sa = torch.sin(angle)
-    C = 1 - ca
-
-    x = axis[..., 0].unsqueeze(1)
-    y = axis[..., 1].unsqueeze(1)
-    z = axis[..., 2].unsqueeze(1)
-
-    xs = x * sa
-    ys = y * sa
-    zs = z * sa
-    xC = x * C
-    yC = y * C
-    zC = z * C
-    xyC = x * yC
-    yzC = y * zC
-    zxC = z * xC
-
-    rot = torch.zeros((vec.shape[0], 4, 4)).to(device=vec.device)
-
-    rot[:, 0, 0] = torch.squeeze(x * xC + ca)
-    rot[:, 0, 1] = torch.squeeze(xyC - zs)
-    rot[:, 0, 2] = torch.squeeze(zxC + ys)
-    rot[:, 1, 0] = torch.squeeze(xyC + zs)
-    rot[:, 1, 1] = torch.squeeze(y * yC + ca)
-    rot[:, 1, 2] = torch.squeeze(yzC - xs)
-    rot[:, 2, 0] = torch.squeeze(zxC - ys)
-    rot[:, 2, 1] = torch.squeeze(yzC + xs)
-    rot[:, 2, 2] = torch.squeeze(z * zC + ca)
-    rot[:, 3, 3] = 1
-
-    return rot
+    return pose_from_axisangle(vec[:, 0], torch.zeros_like(vec[:, 0]))
 
 
 class ConvBlock(nn.Module):
@@ -146,41 +106,52 @@ class Conv3x3(nn.Module):
 
 class BackprojectDepth(nn.Module):
     """Layer to transform a depth image into a point cloud
+    Works with any batch size, the homogeneous ones are cached per batch size, device and dtype.
     """
-    def __init__(self, batch_size, height, width):
+    def __init__(self, height, width):
         super(BackprojectDepth, self).__init__()
 
-        self.batch_size = batch_size
         self.height = height
         self.width = width
 
-        self.ones = nn.Parameter(torch.ones(self.batch_size, 1, self.height * self.width),
-                                 requires_grad=False)
+        self.ones = {}
+
+    def get_ones(self, batch_size, device, dtype):
+        key = (batch_size, device, dtype)
+        if key not in self.ones:
+            self.ones[key] = torch.ones(batch_size, 1, self.height * self.width, device=device, dtype=dtype)
+        return self.ones[key]
 
     def forward(self, depth, norm_pix_coords):
         cam_points = depth * norm_pix_coords
-        cam_points = torch.cat([cam_points.view(self.batch_size, cam_points.shape[1], -1), self.ones], 1)
+        cam_points = cam_points.view(cam_points.shape[0], cam_points.shape[1], -1)
+        ones = self.get_ones(cam_points.shape[0], cam_points.device, cam_points.dtype)
+        cam_points = torch.cat([cam_points, ones], 1)
         return cam_points
 
 
 class Project3D(nn.Module):
     """Layer which projects 3D points into a camera with intrinsics K and at position T
     """
-    def __init__(self, batch_size, height, width, eps=1e-7):
+    def __init__(self, height, width, eps=1e-7):
         super(Project3D, self).__init__()
 
-        self.batch_size = batch_size
         self.height = height
         self.width = width
         self.eps = eps
 
     def forward(self, points, K, T):
         P = torch.matmul(K, T)[:, :3, :]
+        return self.project(points, P)
 
+    @full_precision
+    def project(self, points, P):
+        """Project the points with a precomputed 3x4 projection matrix P = (K @ T)[:, :3]
+        """
         cam_points = torch.matmul(P, points)
 
         pix_coords = cam_points[:, :2, :] / (cam_points[:, 2, :].unsqueeze(1) + self.eps)
-        pix_coords = pix_coords.view(self.batch_size, 2, self.height, self.width)
+        pix_coords = pix_coords.view(-1, 2, self.height, self.width)
         pix_coords[:, 0, :, :] /= self.width - 1
         pix_coords[:, 1, :, :] /= self.height - 1
         pix_coords = (pix_coords - 0.5) * 2
@@ -188,6 +159,81 @@ class Project3D(nn.Module):
         return pix_coords
 
 
+def warp_images(images, sample):
+    """Warp all the images sharing the same sampling grid with a single grid_sample call
+    """
+    channels = [image.shape[1] for image in images]
+    warped = F.grid_sample(torch.cat(images, 1), sample, padding_mode="border", align_corners=True)
+    return torch.split(warped, channels, 1)
+
+
+@contextlib.contextmanager
+def frozen_batch_norm_stats(module):
+    """Keep the batch norm layers of 'module' that are in training mode from updating their
+    running statistics
+    """
+    layers = [m for m in module.modules()
+              if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training and m.track_running_stats]
+    state = [(m.momentum, m.num_batches_tracked.clone()) for m in layers]
+    # a zero momentum keeps the running statistics, and the same tensors are saved for backward
+    for m in layers:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(layers, state):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def checkpoint_if(enabled, module, function, *args):
+    """Run 'function' of 'module', if enabled its activations are recomputed in the backward pass
+    instead of being stored. The recomputation does not update the batch norm statistics again.
+    """
+    if enabled and torch.is_grad_enabled():
+        context_fn = lambda: (contextlib.nullcontext(), frozen_batch_norm_stats(module))
+        return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False, context_fn=context_fn)
+    return function(*args)
+
+
+class MemoryMeter:
+    """Measure the memory used by a forward pass, phase by phase
+    Within the context, the tensors autograd saves for the backward pass are counted on every
+    device (a storage shared by several saved tensors is counted once). On CUDA the peak allocated
+    memory is recorded as well. record(name) adds the totals so far to 'report', in MB. Unless
+    enabled is set, the meter does nothing.
+    """
+    def __init__(self, device, enabled=True):
+        self.device = device
+        self.enabled = enabled
+        self.saved = {}
+        self.report = {}
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda x: x)
+
+    def __enter__(self):
+        if self.enabled:
+            if self.device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(self.device)
+            self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        if self.enabled:
+            self.hooks.__exit__(*args)
+
+    def pack(self, x):
+        storage = x.untyped_storage()
+        self.saved[storage.data_ptr()] = storage.nbytes()
+        return x
+
+    def record(self, name):
+        if not self.enabled:
+            return
+        self.report["saved_memory/" + name] = sum(self.saved.values()) / 2 ** 20
+        if self.device.type == "cuda":
+            self.report["memory/" + name] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+
+
 def upsample(x):
     """Upsample input tensor by a factor of 2
     """
@@ -212,48 +258,70 @@ def get_smooth_loss(disp, img):
     return grad_disp_x.mean() + grad_disp_y.mean()
 
 
-def get_plane_loss(plane_keysets, points_3d):
-
+def gather_keyset_points(keysets, points_3d):
+    """Gather the 3D points of a batch of keysets with a single gather
+    'keysets' is B x S x K (S points in each of the K keysets), 'points_3d' is B x C x N,
+    returns the points as B x C x S x K
+    """
     bs, ch, _ = points_3d.shape
 
-    start_points = torch.gather(points_3d, 2, torch.stack(ch * [plane_keysets[:, 0]], 1))
-    end_points_A = torch.gather(points_3d, 2, torch.stack(ch * [plane_keysets[:, 1]], 1))
-    end_points_B = torch.gather(points_3d, 2, torch.stack(ch * [plane_keysets[:, 2]], 1))
-    end_points_C = torch.gather(points_3d, 2, torch.stack(ch * [plane_keysets[:, 3]], 1))
+    index = keysets.flatten(1).unsqueeze(1).expand(-1, ch, -1)
+    points = torch.gather(points_3d, 2, index)
 
-    vector_A = end_points_A - start_points
-    vector_B = end_points_B - start_points
-    vector_C = end_points_C - start_points
+    return points.view(bs, ch, *keysets.shape[1:])
 
-    AxB = torch.cross(vector_A, vector_B, dim=1)
 
-    AxB_dot_C = torch.sum(AxB*vector_C, dim=1)
+def plane_loss_from_points(points):
+    """Coplanarity loss of B x C x 4 x K keyset points
+    """
+    vectors = points[:, :, 1:] - points[:, :, :1]
+
+    AxB = torch.cross(vectors[:, :, 0], vectors[:, :, 1], dim=1)
+
+    AxB_dot_C = torch.sum(AxB * vectors[:, :, 2], dim=1)
+
+    return torch.abs(AxB_dot_C).mean()
+
 
-    plane_loss = torch.abs(AxB_dot_C).mean()
+def line_loss_from_points(points):
+    """Collinearity loss of B x C x 3 x K keyset points
+    """
+    vectors = points[:, :, 1:] - points[:, :, :1]
+
+    AxB = torch.cross(vectors[:, :, 0], vectors[:, :, 1], dim=1)
+
+    return torch.norm(AxB, p=2, dim=1).mean()
 
-    return plane_loss
+
+def get_plane_loss(plane_keysets, points_3d):
+    return plane_loss_from_points(gather_keyset_points(plane_keysets, points_3d))
 
 
 def get_line_loss(line_keysets, points_3d):
-    bs, ch, _ = points_3d.shape
+    return line_loss_from_points(gather_keyset_points(line_keysets, points_3d))
 
-    start_points = torch.gather(points_3d, 2, torch.stack(ch * [line_keysets[:, 0]], 1))
-    end_points_A = torch.gather(points_3d, 2, torch.stack(ch * [line_keysets[:, 1]], 1))
-    end_points_B = torch.gather(points_3d, 2, torch.stack(ch * [line_keysets[:, 2]], 1))
 
-    vector_A = end_points_A - start_points
-    vector_B = end_points_B - start_points
+def get_plane_line_loss(plane_keysets, line_keysets, points_3d):
+    """Plane and line losses, with the points of both keysets gathered at once
+    """
+    num_plane_points = plane_keysets[0].numel()
+    keysets = torch.cat([plane_keysets.flatten(1), line_keysets.flatten(1)], 1)
 
-    AxB = torch.cross(vector_A, vector_B, dim=1)
+    points = gather_keyset_points(keysets, points_3d)
+    plane_points, line_points = torch.split(points, [num_plane_points, points.shape[2] - num_plane_points], 2)
 
-    line_loss = torch.norm(AxB, p=2, dim=1).mean()
+    plane_loss = plane_loss_from_points(plane_points.unflatten(2, plane_keysets.shape[1:]))
+    line_loss = line_loss_from_points(line_points.unflatten(2, line_keysets.shape[1:]))
 
-    return line_loss
+    return plane_loss, line_loss
 
 class SSIM(nn.Module):
     """Layer to compute the SSIM loss between a pair of images
+    If fused is set, the five local moments are filtered together with a single grouped 3x3 box
+    convolution, which launches fewer kernels but stores more. If checkpoint is set, the moments
+    are recomputed in the backward pass instead of being stored.
     """
-    def __init__(self):
+    def __init__(self, checkpoint=False, fused=False):
         super(SSIM, self).__init__()
         self.mu_x_pool   = nn.AvgPool2d(3, 1)
         self.mu_y_pool   = nn.AvgPool2d(3, 1)
@@ -266,42 +334,77 @@ class SSIM(nn.Module):
         self.C1 = 0.01 ** 2
         self.C2 = 0.03 ** 2
 
+        self.checkpoint = checkpoint
+        self.fused = fused
+
     def forward(self, x, y):
+        if self.checkpoint and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(self.compute_ssim, x, y, use_reentrant=False)
+        return self.compute_ssim(x, y)
+
+    @full_precision
+    def compute_ssim(self, x, y):
         x = self.refl(x)
         y = self.refl(y)
 
-        mu_x = self.mu_x_pool(x)
-        mu_y = self.mu_y_pool(y)
+        if self.fused:
+            mu_x, mu_y, sigma_x, sigma_y, sigma_xy = self.filter_moments(x, y)
+        else:
+            mu_x = self.mu_x_pool(x)
+            mu_y = self.mu_y_pool(y)
+            sigma_x = self.sig_x_pool(x ** 2)
+            sigma_y = self.sig_y_pool(y ** 2)
+            sigma_xy = self.sig_xy_pool(x * y)
 
-        sigma_x  = self.sig_x_pool(x ** 2) - mu_x ** 2
-        sigma_y  = self.sig_y_pool(y ** 2) - mu_y ** 2
-        sigma_xy = self.sig_xy_pool(x * y) - mu_x * mu_y
+        sigma_x  = sigma_x - mu_x ** 2
+        sigma_y  = sigma_y - mu_y ** 2
+        sigma_xy = sigma_xy - mu_x * mu_y
 
         SSIM_n = (2 * mu_x * mu_y + self.C1) * (2 * sigma_xy + self.C2)
         SSIM_d = (mu_x ** 2 + mu_y ** 2 + self.C1) * (sigma_x + sigma_y + self.C2)
 
         return torch.clamp((1 - SSIM_n / SSIM_d) / 2, 0, 1)
 
+    def filter_moments(self, x, y):
+        """Box filter x, y, x^2, y^2 and x*y with one depthwise (grouped) convolution
+        """
+        moments = torch.cat([x, y, x ** 2, y ** 2, x * y], 1)
+        num_channels = moments.shape[1]
+        weight = moments.new_full((num_channels, 1, 3, 3), 1 / 9)
+        return torch.chunk(F.conv2d(moments, weight, groups=num_channels), 5, 1)
 
-def compute_depth_errors(gt, pred):
+
+def compute_depth_errors(gt, pred, mask=None):
     """Computation of error metrics between predicted and ground truth depths
+    With a mask, the errors are averaged over the pixels of the mask, without indexing the depths
+    (which would wait for the device to count them).
     """
+    if mask is None:
+        mean = torch.mean
+    else:
+        gt = torch.where(mask, gt, torch.ones_like(gt))
+        pred = torch.where(mask, pred, torch.ones_like(pred))
+        num_pixels = mask.sum()
+
+        def mean(x):
+            return (x * mask).sum() / num_pixels
+
     thresh = torch.max((gt / pred), (pred / gt))
-    a1 = (thresh < 1.25     ).float().mean()
-    a2 = (thresh < 1.25 ** 2).float().mean()
-    a3 = (thresh < 1.25 ** 3).float().mean()
+    a1 = mean((thresh < 1.25     ).float())
+    a2 = mean((thresh < 1.25 ** 2).float())
+    a3 = mean((thresh < 1.25 ** 3).float())
 
-    log10 = torch.mean(torch.abs(torch.log10(pred / gt)))
+    log10 = mean(torch.abs(torch.log10(pred / gt)))
 
     rmse = (gt - pred) ** 2
-    rmse = torch.sqrt(rmse.mean())
+    rmse = torch.sqrt(mean(rmse))
 
     rmse_log = (torch.log(gt) - torch.log(pred)) ** 2
-    rmse_log = torch.sqrt(rmse_log.mean())
+    rmse_log = torch.sqrt(mean(rmse_log))
 
-    abs_rel = torch.mean(torch.abs(gt - pred) / gt)
+    abs_rel = mean(torch.abs(gt - pred) / gt)
 
-    sq_rel = torch.mean((gt - pred) ** 2 / gt)
+    sq_rel = mean((gt - pred) ** 2 / gt)
 
     return abs_rel, sq_rel, rmse, rmse_log, log10, a1, a2, a3
 
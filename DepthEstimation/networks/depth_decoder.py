@@ -93,7 +93,8 @@ class Conv3x3(nn.Module):
 
 
 class DepthDecoder(nn.Module):
-    def __init__(self, num_ch_enc, scales=range(4), num_output_channels=3, use_skips=True, PixelCoorModu=True):
+    def __init__(self, num_ch_enc, scales=range(4), num_output_channels=3, use_skips=True, PixelCoorModu=True,
+                 checkpoint=False):
         super(DepthDecoder, self).__init__()
 
         self.num_output_channels = num_output_channels
@@ -101,6 +102,9 @@ class DepthDecoder(nn.Module):
         self.upsample_mode = 'nearest'
         self.scales = scales
 
+        # if set, only the output of each upconv level is stored for the backward pass
+        self.checkpoint = checkpoint
+
         self.num_ch_enc = num_ch_enc
         self.num_ch_dec = np.array([16, 32, 64, 128, 256])
 
@@ -133,12 +137,8 @@ class DepthDecoder(nn.Module):
         # decoder
         x = input_features[-1]
         for i in range(4, -1, -1):
-            x = self.convs[("upconv", i, 0)](x)
-            x = [upsample(x)]
-            if self.use_skips and i > 0:
-                x += [input_features[i - 1]]
-            x = torch.cat(x, 1)
-            x = self.convs[("upconv", i, 1)](x)
+            skips = [input_features[i - 1]] if self.use_skips and i > 0 else []
+            x = checkpoint_if(self.checkpoint, self, self.upconv, i, x, *skips)
             if i in self.scales:
                 feat = self.convs[("dispconv", i)](x)
 
@@ -156,3 +156,8 @@ class DepthDecoder(nn.Module):
                     self.outputs[("disp", i)] = F.relu((feat * norm_pix_coords[i]).sum(1, keepdim=True), inplace=True)
 
         return self.outputs
+
+    def upconv(self, i, x, *skips):
+        x = self.convs[("upconv", i, 0)](x)
+        x = torch.cat([upsample(x)] + list(skips), 1)
+        return self.convs[("upconv", i, 1)](x)
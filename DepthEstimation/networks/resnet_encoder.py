@@ -13,6 +13,8 @@ import torch.nn as nn
 import torchvision.models as models
 import torch.utils.model_zoo as model_zoo
 
+from layers import checkpoint_if
+
 
 class ResNetMultiImageInput(models.ResNet):
     """Constructs a resnet model with varying number of input images.
@@ -61,11 +63,13 @@ def resnet_multiimage_input(num_layers, pretrained=False, num_input_images=1):
 
 class ResnetEncoder(nn.Module):
     """Pytorch module for a resnet encoder
+    If checkpoint is set, only the features of each resolution are stored for the backward pass.
     """
-    def __init__(self, num_layers, pretrained, num_input_images=1):
+    def __init__(self, num_layers, pretrained, num_input_images=1, checkpoint=False):
         super(ResnetEncoder, self).__init__()
 
         self.num_ch_enc = np.array([64, 64, 128, 256, 512])
+        self.checkpoint = checkpoint
 
         resnets = {18: models.resnet18,
                    34: models.resnet34,
@@ -86,13 +90,19 @@ class ResnetEncoder(nn.Module):
 
     def forward(self, input_image):
         self.features = []
+        self.features.append(checkpoint_if(self.checkpoint, self, self.stem, input_image))
+        self.features.append(checkpoint_if(self.checkpoint, self, self.layer1, self.features[-1]))
+        self.features.append(checkpoint_if(self.checkpoint, self, self.encoder.layer2, self.features[-1]))
+        self.features.append(checkpoint_if(self.checkpoint, self, self.encoder.layer3, self.features[-1]))
+        self.features.append(checkpoint_if(self.checkpoint, self, self.encoder.layer4, self.features[-1]))
+
+        return self.features
+
+    def stem(self, input_image):
         x = (input_image - 0.45) / 0.225
         x = self.encoder.conv1(x)
         x = self.encoder.bn1(x)
-        self.features.append(self.encoder.relu(x))
-        self.features.append(self.encoder.layer1(self.encoder.maxpool(self.features[-1])))
-        self.features.append(self.encoder.layer2(self.features[-1]))
-        self.features.append(self.encoder.layer3(self.features[-1]))
-        self.features.append(self.encoder.layer4(self.features[-1]))
+        return self.encoder.relu(x)
 
-        return self.features
+    def layer1(self, x):
+        return self.encoder.layer1(self.encoder.maxpool(x))
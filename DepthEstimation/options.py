@@ -25,6 +25,10 @@ class MonodepthOptions:
                                  type=str,
                                  help="log directory",
                                  default=os.path.join(os.getcwd(), "tmp"))
+        self.parser.add_argument("--structure_cache_dir",
+                                 type=str,
+                                 help="where lazily extracted plane/line label maps are cached, "
+                                      "defaults to the data path (the files are named after the extractor backend)")
 
         # TRAINING options
         self.parser.add_argument("--model_name",
@@ -76,8 +80,13 @@ class MonodepthOptions:
         # OPTIMIZATION options
         self.parser.add_argument("--batch_size",
                                  type=int,
-                                 help="batch size",
+                                 help="batch size (of each process in distributed training)",
                                  default=16)
+        self.parser.add_argument("--accumulation_steps",
+                                 type=int,
+                                 help="number of micro-batches the batch is split into, their "
+                                      "gradients are accumulated before each optimizer step",
+                                 default=1)
         self.parser.add_argument("--learning_rate",
                                  type=float,
                                  help="learning rate",
@@ -105,6 +114,20 @@ class MonodepthOptions:
                                  help="how many images the pose network gets",
                                  default="pairs",
                                  choices=["pairs", "all"])
+        self.parser.add_argument("--num_refinement_stages",
+                                 type=int,
+                                 help="number of warp-and-re-estimate pose stages, the first one "
+                                      "estimates the pose from the input frames",
+                                 default=3)
+        self.parser.add_argument("--refinement_frequency",
+                                 type=int,
+                                 help="if larger than 1, the stages after the first one only run "
+                                      "every refinement_frequency training steps",
+                                 default=1)
+        self.parser.add_argument("--refinement_start_epoch",
+                                 type=int,
+                                 help="epoch from which the stages after the first one are trained",
+                                 default=0)
 
         # hyper-parameter
         self.parser.add_argument("--smoothness_weight",
@@ -156,11 +179,72 @@ class MonodepthOptions:
                                  type=int,
                                  help="number of dataloader workers",
                                  default=12)
+        self.parser.add_argument("--dist_backend",
+                                 type=str,
+                                 help="backend of the distributed training launched with torchrun, "
+                                      "defaults to nccl on the GPU and gloo on the CPU",
+                                 choices=["nccl", "gloo"])
+        self.parser.add_argument("--activation_checkpointing",
+                                 nargs="*",
+                                 type=str,
+                                 help="networks whose activations are recomputed in the backward pass "
+                                      "instead of being stored, to save memory",
+                                 default=[],
+                                 choices=["encoder", "decoder", "pose_encoder"])
+        self.parser.add_argument("--compile",
+                                 help="if set, the networks, the warping and the reprojection loss "
+                                      "are compiled with torch.compile. It is not faster in general (on the CPU "
+                                      "steps were up to 25%% slower) and it stores more activations, measure "
+                                      "it first with benchmark_compile.py",
+                                 action="store_true")
+        self.parser.add_argument("--compile_cache_dir",
+                                 type=str,
+                                 help="where the compiled kernels are cached across runs, "
+                                      "defaults to the torch inductor cache in the temporary folder")
+        self.parser.add_argument("--ssim_checkpoint",
+                                 help="if set, the SSIM moments are recomputed in the backward pass "
+                                      "instead of being stored, to save memory",
+                                 action="store_true")
+        self.parser.add_argument("--ssim_fused",
+                                 help="if set, the SSIM moments are filtered with a single grouped "
+                                      "convolution, fewer kernel launches but more memory (slower on the CPU)",
+                                 action="store_true")
+        self.parser.add_argument("--amp",
+                                 help="if set, trains with mixed precision (autocast), the depth "
+                                      "conversion, the poses, the projection and SSIM stay in float32",
+                                 action="store_true")
+        self.parser.add_argument("--amp_dtype",
+                                 type=str,
+                                 help="autocast dtype, defaults to bfloat16 on the CPU and float16 "
+                                      "(with loss scaling) on the GPU",
+                                 choices=["float16", "bfloat16"])
+        self.parser.add_argument("--log_memory",
+                                 help="if set, logs the memory saved for the backward pass (and the peak "
+                                      "GPU memory) after the depth prediction, each refinement stage and the losses",
+                                 action="store_true")
+        self.parser.add_argument("--lazy_structure_extraction",
+                                 help="if set, missing plane/line label maps are extracted by the "
+                                      "dataloader workers on first access instead of by the offline preprocessing",
+                                 action="store_true")
+        self.parser.add_argument("--plane_extractor",
+                                 type=str,
+                                 help="superpixel backend used by the lazy structure extraction",
+                                 default="felzenszwalb",
+                                 choices=["felzenszwalb", "felzenszwalb_lowres", "slic", "slic_lowres"])
+        self.parser.add_argument("--line_extractor",
+                                 type=str,
+                                 help="line segment backend used by the lazy structure extraction",
+                                 default="lsd",
+                                 choices=["lsd", "lsd_0.8", "lsd_0.5"])
 
         # LOADING options
         self.parser.add_argument("--load_weights_folder",
                                  type=str,
-                                 help="name of model to load")
+                                 help="checkpoint file, or folder with one file per model, to load")
+        self.parser.add_argument("--resume",
+                                 help="if set, resumes training from the last checkpoint of the model, "
+                                      "see --checkpoint_frequency",
+                                 action="store_true")
         self.parser.add_argument("--models_to_load",
                                  nargs="+",
                                  type=str,
@@ -172,10 +256,37 @@ class MonodepthOptions:
                                  type=int,
                                  help="number of batches between each tensorboard log",
                                  default=250)
+        self.parser.add_argument("--log_images",
+                                 type=int,
+                                 help="maximum number of samples whose images are logged",
+                                 default=4)
+        self.parser.add_argument("--log_image_frequency",
+                                 type=int,
+                                 help="number of tensorboard logs between each image log",
+                                 default=1)
+        self.parser.add_argument("--log_image_downscale",
+                                 type=int,
+                                 help="factor the logged images are downsampled by",
+                                 default=2)
         self.parser.add_argument("--save_frequency",
                                  type=int,
                                  help="number of epochs between each save",
                                  default=1)
+        self.parser.add_argument("--val_mode",
+                                 type=str,
+                                 help="validation with all the losses, or with the depth metrics only "
+                                      "(encoder, scale network and depth decoder)",
+                                 default="full",
+                                 choices=["full", "depth"])
+        self.parser.add_argument("--val_samples",
+                                 type=int,
+                                 help="if larger than 0, validates on a fixed subset of this many samples",
+                                 default=0)
+        self.parser.add_argument("--checkpoint_frequency",
+                                 type=int,
+                                 help="if larger than 0, number of steps between each checkpoint "
+                                      "training can be resumed from (see --resume)",
+                                 default=0)
 
         # EVALUATION options
         self.parser.add_argument("--disable_median_scaling",
@@ -209,4 +320,6 @@ class MonodepthOptions:
 
     def parse(self):
         self.options = self.parser.parse_args()
+        if self.options.refinement_frequency < 1:
+            self.parser.error("--refinement_frequency must be at least 1")
         return self.options
@@ -0,0 +1,84 @@
+# benchmarks the plane/line extractor backends: speed and plane/line label statistics on a sample of NYU
+
+import os
+import sys
+import time
+
+import numpy as np
+
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datasets.structures import extract_superpixel, extract_lineseg, PLANE_EXTRACTORS, LINE_EXTRACTORS, CROP
+from utils import readlines
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_path', type=str,
+                    help='path to nyu data',
+                    required=True)
+parser.add_argument('--split', type=str,
+                    help='which split file to sample the frames from',
+                    default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                         "splits", "nyu", "train_files.txt"))
+parser.add_argument('--num_samples', type=int,
+                    help='number of frames to benchmark on',
+                    default=100)
+parser.add_argument('--plane_backends', nargs='+', type=str,
+                    help='plane extractor backends to benchmark',
+                    default=list(PLANE_EXTRACTORS),
+                    choices=list(PLANE_EXTRACTORS))
+parser.add_argument('--line_backends', nargs='+', type=str,
+                    help='line extractor backends to benchmark',
+                    default=list(LINE_EXTRACTORS),
+                    choices=list(LINE_EXTRACTORS))
+
+args = parser.parse_args()
+
+
+def benchmark(extract, backend, filenames):
+    """Run one backend over the sampled frames, returns frames/s and label statistics
+    """
+    num_labels = []
+    coverage = []
+    label_size = []
+
+    start_time = time.time()
+    for filename in filenames:
+        label_map = extract(filename, backend)[CROP:-CROP, CROP:-CROP]
+
+        n = int(label_map.max())
+        num_labels.append(n)
+        coverage.append(np.mean(label_map > 0))
+        if n > 0:
+            label_size.append(np.sum(label_map > 0) / n)
+    duration = time.time() - start_time
+
+    num_labels = np.array(num_labels)
+    return [len(filenames) / duration,
+            num_labels.mean(),
+            np.mean(num_labels == 0),
+            np.mean(coverage),
+            np.mean(label_size) if len(label_size) else 0]
+
+
+# evenly spaced frames, so that every run benchmarks the same sample
+lines = readlines(args.split)
+lines = [lines[i] for i in np.linspace(0, len(lines) - 1, min(args.num_samples, len(lines))).astype(int)]
+
+filenames = []
+for line in lines:
+    folder, frame_index = line.split()[:2]
+    filenames.append(os.path.join(args.data_path, folder, "{}.jpg".format(int(frame_index))))
+
+print("-> Benchmarking on {} frames of {}".format(len(filenames), args.split))
+print("\n  " + ("{:>20} | " + "{:>10} | " * 5).format(
+    "backend", "frames/s", "labels", "empty", "coverage", "label px"))
+
+for backend in args.plane_backends:
+    results = benchmark(extract_superpixel, backend, filenames)
+    print("  " + ("{:>20} | " + "{:10.2f} | " * 5).format("plane/" + backend, *results))
+
+for backend in args.line_backends:
+    results = benchmark(extract_lineseg, backend, filenames)
+    print("  " + ("{:>20} | " + "{:10.2f} | " * 5).format("line/" + backend, *results))
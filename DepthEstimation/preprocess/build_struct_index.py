@@ -0,0 +1,75 @@
+# builds the per-frame CSR index of the plane/line pixels used to sample keysets during training
+
+import os
+import sys
+import glob
+
+import numpy as np
+from PIL import Image
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+import tqdm
+from functools import partial
+
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datasets.struct_index import build_struct_index_pyramid
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_path', type=str,
+                    help='path to nyu data',
+                    required=True)
+parser.add_argument('--height', type=int,
+                    help='input image height used for training',
+                    default=256)
+parser.add_argument('--width', type=int,
+                    help='input image width used for training',
+                    default=320)
+parser.add_argument('--num_scales', type=int,
+                    help='number of scales used in the loss',
+                    default=4)
+
+args = parser.parse_args()
+
+data_path = args.data_path
+
+train_dir = os.path.join(data_path, "nyu2_train")
+train_scenes = sorted([name for name in os.listdir(train_dir) if os.path.isdir(os.path.join(train_dir, name))])
+
+test_dir = os.path.join(data_path, "nyu2_test")
+
+
+def label2index(filename, suffix):
+    CROP = 16
+    label = Image.open(filename)
+    w, h = label.size
+
+    label = label.crop((CROP, CROP, w - CROP, h - CROP))
+    struct_index = build_struct_index_pyramid(label, args.height, args.width, args.num_scales)
+
+    np.savez_compressed(filename[:-len(suffix)] + suffix.replace(".png", "_index.npz"), **struct_index)
+
+    return
+
+
+# multi processing fitting
+executor = ProcessPoolExecutor(max_workers=cpu_count())
+futures = []
+
+for scene in train_scenes:
+    for suffix in ["_seg.png", "_line.png"]:
+        search = os.path.join(train_dir, scene) + "/*" + suffix
+        for file in sorted(glob.glob(search)):
+            task = partial(label2index, file, suffix)
+            futures.append(executor.submit(task))
+
+for suffix in ["_seg.png", "_line.png"]:
+    for file in sorted(glob.glob(test_dir + "/*" + suffix)):
+        task = partial(label2index, file, suffix)
+        futures.append(executor.submit(task))
+
+results = []
+[results.append(future.result()) for future in tqdm.tqdm(futures)]
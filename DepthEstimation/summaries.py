@@ -0,0 +1,59 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import torch
+from tensorboardX import SummaryWriter
+
+from background import BackgroundWorker
+
+
+class SummaryLogger(BackgroundWorker):
+    """Write tensorboard summaries in a background thread
+    The scalars and images of a log step are copied to the CPU without waiting for the device, the
+    thread waits for the copies and writes them.
+    """
+    def __init__(self, log_path, modes, max_queued=4):
+        self.writers = {mode: SummaryWriter(os.path.join(log_path, mode)) for mode in modes}
+        super(SummaryLogger, self).__init__(max_queued)
+
+    def log(self, mode, step, scalars, images):
+        """Queue the summaries of 'step'
+        'scalars' maps tags to numbers or tensors, 'images' maps tags to batches of images (N, C, H, W)
+        which are written as "tag/j" for each image j.
+        """
+        scalars = {k: to_cpu_async(v) for k, v in scalars.items()}
+        images = {k: to_cpu_async(v) for k, v in images.items()}
+
+        copied = None
+        if any(torch.is_tensor(v) and v.is_cuda for v in list(scalars.values()) + list(images.values())):
+            copied = torch.cuda.Event()
+            copied.record()
+
+        self.put(mode, step, scalars, images, copied)
+
+    def wait(self):
+        """Block until all the queued summaries are written
+        """
+        super(SummaryLogger, self).wait()
+        for writer in self.writers.values():
+            writer.flush()
+
+    def process(self, mode, step, scalars, images, copied):
+        if copied is not None:
+            copied.synchronize()
+
+        writer = self.writers[mode]
+        for tag, value in scalars.items():
+            writer.add_scalar(tag, float(value), step)
+        for tag, batch in images.items():
+            for j in range(batch.shape[0]):
+                writer.add_image("{}/{}".format(tag, j), batch[j], step)
+
+
+def to_cpu_async(value):
+    """Start copying a tensor to the CPU, the copy is only complete once the device has caught up
+    """
+    if torch.is_tensor(value):
+        return value.detach().to("cpu", non_blocking=True)
+    return value
@@ -0,0 +1,103 @@
+# tests of the precomputed plane/line indices read by MonoDataset, on a few synthetic NYU frames
+#   python -m pytest tests
+
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datasets import NYUDataset
+from datasets.struct_index import build_struct_index_pyramid
+
+
+HEIGHT = 64
+WIDTH = 96
+NUM_SCALES = 2
+NUM_FRAMES = 3
+
+
+def make_frames(data_path):
+    """Write NUM_FRAMES colour images, depths and plane/line label maps to 'data_path'/scene
+    """
+    rng = np.random.RandomState(0)
+    scene = os.path.join(data_path, "scene")
+    os.makedirs(scene)
+    for i in range(NUM_FRAMES):
+        Image.fromarray((rng.rand(480, 640, 3) * 255).astype(np.uint8)).save(os.path.join(scene, "{}.jpg".format(i)))
+        Image.fromarray((rng.rand(480, 640) * 200 + 20).astype(np.uint8)).save(os.path.join(scene, "{}.png".format(i)))
+
+        plane = np.zeros((480, 640), np.uint8)
+        line = np.zeros((480, 640), np.uint8)
+        for k in range(1, 6):
+            y, x = rng.randint(16, 400), rng.randint(16, 560)
+            plane[y:y + 60, x:x + 60] = k
+            line[rng.randint(20, 460), 20:600] = k
+        Image.fromarray(plane).save(os.path.join(scene, "{}_seg.png".format(i)))
+        Image.fromarray(line).save(os.path.join(scene, "{}_line.png".format(i)))
+    return ["scene {}".format(i) for i in range(NUM_FRAMES)]
+
+
+def write_index(data_path, frame_index, height=HEIGHT, width=WIDTH, num_scales=NUM_SCALES):
+    """Index the label maps of a frame as preprocess/build_struct_index.py does
+    """
+    for suffix in ["_seg", "_line"]:
+        label = Image.open(os.path.join(data_path, "scene", "{}{}.png".format(frame_index, suffix)))
+        label = label.crop((16, 16, 640 - 16, 480 - 16))
+        struct_index = build_struct_index_pyramid(label, height, width, num_scales)
+        np.savez_compressed(os.path.join(data_path, "scene", "{}{}_index.npz".format(frame_index, suffix)),
+                            **struct_index)
+
+
+def make_dataset(data_path, filenames):
+    return NYUDataset(data_path, filenames, HEIGHT, WIDTH, [0], NUM_SCALES,
+                      return_plane=True, num_plane_keysets=16, return_line=True, num_line_keysets=8)
+
+
+def get_keysets(dataset, index):
+    np.random.seed(0)
+    inputs = dataset[index]
+    return {k: v for k, v in inputs.items() if "keysets" in k[0]}
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    data_path = str(tmp_path)
+    filenames = make_frames(data_path)
+    expected = [get_keysets(make_dataset(data_path, filenames), i) for i in range(NUM_FRAMES)]
+    return data_path, filenames, expected
+
+
+def test_frame_without_index_falls_back(data_path):
+    data_path, filenames, expected = data_path
+    write_index(data_path, 0)
+    write_index(data_path, 2)
+
+    dataset = make_dataset(data_path, filenames)
+    assert dataset.load_plane_index and dataset.load_line_index
+
+    # frame 1 has no index, its keysets are drawn from an index built on the fly
+    for i in range(NUM_FRAMES):
+        keysets = get_keysets(dataset, i)
+        assert sorted(keysets) == sorted(expected[i])
+        for k in keysets:
+            np.testing.assert_array_equal(keysets[k].numpy(), expected[i][k].numpy())
+
+
+def test_stale_index_is_ignored(data_path):
+    data_path, filenames, expected = data_path
+    write_index(data_path, 0)
+    write_index(data_path, 1, height=2 * HEIGHT, width=2 * WIDTH)
+    write_index(data_path, 2, num_scales=1)
+
+    dataset = make_dataset(data_path, filenames)
+    for i in [1, 2]:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            keysets = get_keysets(dataset, i)
+        assert any("ignoring the" in str(w.message) for w in caught)
+        for k in keysets:
+            np.testing.assert_array_equal(keysets[k].numpy(), expected[i][k].numpy())
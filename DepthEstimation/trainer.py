@@ -6,17 +6,24 @@ from __future__ import absolute_import, division, print_function
 
 import numpy as np
 import time
+import random
+import itertools
+import contextlib
 
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import DataLoader
-from tensorboardX import SummaryWriter
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler, Subset
 
 import json
 
 from utils import *
 from layers import *
+from geometry import pose_from_axisangle, accumulate_poses
+from checkpoint import CheckpointWriter, map_tensors, state_to_cpu, load_weights
+from summaries import SummaryLogger
 
 import datasets
 import networks
@@ -35,7 +42,20 @@ class Trainer:
         self.models = {}
         self.parameters_to_train = []
 
-        self.device = torch.device("cpu" if self.opt.no_cuda else "cuda")
+        # distributed data parallel training, when launched with torchrun
+        self.world_size = int(os.environ.get("WORLD_SIZE", 1))
+        self.rank = int(os.environ.get("RANK", 0))
+        self.distributed = self.world_size > 1
+        self.is_main = self.rank == 0
+
+        if self.distributed:
+            local_rank = int(os.environ.get("LOCAL_RANK", 0))
+            dist.init_process_group(self.opt.dist_backend or ("gloo" if self.opt.no_cuda else "nccl"))
+            if not self.opt.no_cuda:
+                torch.cuda.set_device(local_rank)
+            self.device = torch.device("cpu") if self.opt.no_cuda else torch.device("cuda", local_rank)
+        else:
+            self.device = torch.device("cpu" if self.opt.no_cuda else "cuda")
 
         self.num_scales = len(self.opt.scales)
         self.num_input_frames = len(self.opt.frame_ids)
@@ -44,7 +64,8 @@ class Trainer:
         assert self.opt.frame_ids[0] == 0, "frame_ids must start with 0"
 
         self.models["encoder"] = networks.ResnetEncoder(
-            self.opt.num_layers, self.opt.weights_init == "pretrained")
+            self.opt.num_layers, self.opt.weights_init == "pretrained",
+            checkpoint="encoder" in self.opt.activation_checkpointing)
         self.models["encoder"].to(self.device)
         self.parameters_to_train += list(self.models["encoder"].parameters())
         
@@ -62,13 +83,15 @@ class Trainer:
 
 
         self.models["depth"] = networks.DepthDecoder(self.models["encoder"].num_ch_enc, self.opt.scales,
-                                                     PixelCoorModu = not self.opt.disable_pixel_coordinate_modulation)
+                                                     PixelCoorModu = not self.opt.disable_pixel_coordinate_modulation,
+                                                     checkpoint="decoder" in self.opt.activation_checkpointing)
         self.models["depth"].to(self.device)
         self.parameters_to_train += list(self.models["depth"].parameters())
 
         self.models["pose_encoder"] = networks.ResnetEncoder(self.opt.num_layers,
                                                              self.opt.weights_init == "pretrained",
-                                                             num_input_images=self.num_pose_frames)
+                                                             num_input_images=self.num_pose_frames,
+                                                             checkpoint="pose_encoder" in self.opt.activation_checkpointing)
 
         self.models["pose_encoder"].to(self.device)
         self.parameters_to_train += list(self.models["pose_encoder"].parameters())
@@ -93,16 +116,69 @@ class Trainer:
         self.models["pose_third"].to(self.device)
         self.parameters_to_train += list(self.models["pose_third"].parameters())
 
+        # refinement stages, each one re-estimates the pose on the source frames warped by the
+        # previous one. The first three keep the names of their outputs and pose decoders
+        assert self.opt.num_refinement_stages >= 1, "num_refinement_stages must be at least 1"
+        stage_names = ["ori", "second", "third"]
+        stage_pose_decoders = ["pose_rec", "pose", "pose_third"]
+        stage_colors = ["color_ori", "color", "color_new"]
+        stage_reprojection_losses = ["ori", "vitual", "new"]
+
+        self.stages = []
+        for k in range(self.opt.num_refinement_stages):
+            if k < 3:
+                stage = {"name": stage_names[k], "pose": stage_pose_decoders[k],
+                         "color": stage_colors[k], "reprojection": stage_reprojection_losses[k]}
+            else:
+                stage = {"name": "stage{}".format(k), "pose": "pose_stage{}".format(k),
+                         "color": "color_stage{}".format(k), "reprojection": "stage{}".format(k)}
+
+                self.models[stage["pose"]] = networks.PoseDecoder(self.models["pose_encoder"].num_ch_enc,
+                                                                  num_input_features=1,
+                                                                  num_frames_to_predict_for=(self.num_pose_frames-1))
+                self.models[stage["pose"]].to(self.device)
+                self.parameters_to_train += list(self.models[stage["pose"]].parameters())
+
+            stage["color_aug"] = stage["color"].replace("color", "color_aug")
+            # the first stage only gives a coarse alignment
+            stage["weight"] = 0.25 if k == 0 else 1.0
+            self.stages.append(stage)
+
         self.model_optimizer = optim.Adam(self.parameters_to_train, self.opt.learning_rate)
         self.model_lr_scheduler = optim.lr_scheduler.StepLR(
             self.model_optimizer, self.opt.scheduler_step_size, 0.1)
 
+        # mixed precision: bfloat16 on the CPU, float16 on the GPU unless asked otherwise,
+        # float16 gradients need loss scaling
+        self.amp_dtype = None
+        if self.opt.amp:
+            amp_dtype = self.opt.amp_dtype or ("bfloat16" if self.device.type == "cpu" else "float16")
+            self.amp_dtype = getattr(torch, amp_dtype)
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=self.amp_dtype == torch.float16)
+
         if self.opt.load_weights_folder is not None:
             self.load_model()
 
-        print("Training model named:\n  ", self.opt.model_name)
-        print("Models and tensorboard events files are saved to:\n  ", self.opt.log_dir)
-        print("Training is using:\n  ", self.device)
+        self.training_state = None
+        if self.opt.resume:
+            self.load_training_state()
+
+        if self.distributed:
+            # the weights of rank 0 are broadcast to the other processes. The fc layers of the
+            # resnet encoders are never used, and the pose decoders of the skipped refinement
+            # stages get no gradients
+            for n in self.models:
+                self.models[n] = DistributedDataParallel(
+                    self.models[n], device_ids=None if self.opt.no_cuda else [self.device.index],
+                    find_unused_parameters=True)
+
+        if self.is_main:
+            print("Training model named:\n  ", self.opt.model_name)
+            print("Models and tensorboard events files are saved to:\n  ", self.opt.log_dir)
+            print("Training is using:\n  ", self.device)
+            if self.distributed:
+                print("Distributed over {:d} processes, {:d} samples per process".format(
+                    self.world_size, self.opt.batch_size))
 
         # data
         datasets_dict = {"nyu": datasets.NYUDataset}
@@ -114,8 +190,13 @@ class Trainer:
         val_filenames = readlines(fpath.format("val"))
         img_ext = '.jpg'
 
+        # each optimizer step accumulates the gradients of accumulation_steps micro-batches
+        assert self.opt.batch_size % self.opt.accumulation_steps == 0, \
+            "'batch_size' must be a multiple of 'accumulation_steps'"
+        micro_batch_size = self.opt.batch_size // self.opt.accumulation_steps
+
         num_train_samples = len(train_filenames)
-        self.num_total_steps = num_train_samples // self.opt.batch_size * self.opt.num_epochs
+        self.num_total_steps = num_train_samples // (self.opt.batch_size * self.world_size) * self.opt.num_epochs
 
         train_dataset = self.dataset(
             self.opt.data_path, train_filenames, self.opt.height, self.opt.width,
@@ -123,31 +204,55 @@ class Trainer:
             return_plane=not self.opt.disable_plane_regularization,
             num_plane_keysets = self.opt.num_plane_keysets,
             return_line=not self.opt.disable_line_regularization,
-            num_line_keysets = self.opt.num_line_keysets)
-
+            num_line_keysets = self.opt.num_line_keysets,
+            lazy_structure_extraction=self.opt.lazy_structure_extraction,
+            structure_cache_dir=self.opt.structure_cache_dir,
+            plane_extractor=self.opt.plane_extractor,
+            line_extractor=self.opt.line_extractor)
+
+        # each process loads its own shard of the split, in an order that can be resumed
+        seed = 0 if self.distributed else int(torch.empty((), dtype=torch.int64).random_())
+        train_sampler = datasets.ResumableSampler(train_dataset, self.world_size, self.rank, seed)
+        # the worker seeds are drawn from a generator of their own, so that starting an epoch
+        # does not consume the global RNG
         self.train_loader = DataLoader(
-            train_dataset, self.opt.batch_size, True,
-            num_workers=self.opt.num_workers, pin_memory=True, drop_last=True)
+            train_dataset, micro_batch_size, False, sampler=train_sampler,
+            num_workers=self.opt.num_workers, pin_memory=True, drop_last=True,
+            generator=torch.Generator().manual_seed(seed))
 
+        # the depth-only validation needs neither the source frames nor the planes and lines
+        depth_only_val = self.opt.val_mode == "depth"
         val_dataset = self.dataset(
             self.opt.data_path, val_filenames, self.opt.height, self.opt.width,
-            self.opt.frame_ids, self.num_scales, is_train=False, img_ext=img_ext,
-            return_plane=not self.opt.disable_plane_regularization,
+            [0] if depth_only_val else self.opt.frame_ids, self.num_scales, is_train=False, img_ext=img_ext,
+            return_plane=not (self.opt.disable_plane_regularization or depth_only_val),
             num_plane_keysets = self.opt.num_plane_keysets,
-            return_line=not self.opt.disable_line_regularization,
-            num_line_keysets = self.opt.num_line_keysets)
-
+            return_line=not (self.opt.disable_line_regularization or depth_only_val),
+            num_line_keysets = self.opt.num_line_keysets,
+            lazy_structure_extraction=self.opt.lazy_structure_extraction,
+            structure_cache_dir=self.opt.structure_cache_dir,
+            plane_extractor=self.opt.plane_extractor,
+            line_extractor=self.opt.line_extractor)
+
+        if self.opt.val_samples > 0:
+            # a fixed subset, spread evenly over the validation set
+            val_indices = np.linspace(0, len(val_dataset) - 1, min(self.opt.val_samples, len(val_dataset)))
+            val_dataset = Subset(val_dataset, np.round(val_indices).astype(int).tolist())
+
+        # the validation always goes through the same batches, in the same order
+        val_sampler = DistributedSampler(val_dataset, shuffle=False) if self.distributed else None
         self.val_loader = DataLoader(
-            val_dataset, self.opt.batch_size, True,
-            num_workers=self.opt.num_workers, pin_memory=True, drop_last=True)
+            val_dataset, micro_batch_size, False, sampler=val_sampler,
+            num_workers=self.opt.num_workers, pin_memory=True, drop_last=False)
         self.val_iter = iter(self.val_loader)
 
-        self.writers = {}
-        for mode in ["train", "val"]:
-            self.writers[mode] = SummaryWriter(os.path.join(self.log_path, mode))
+        # only the main process logs and saves
+        self.num_logs = {"train": 0, "val": 0}
+        if self.is_main:
+            self.summary_logger = SummaryLogger(self.log_path, ["train", "val"])
 
         if not self.opt.no_ssim:
-            self.ssim = SSIM()
+            self.ssim = SSIM(checkpoint=self.opt.ssim_checkpoint, fused=self.opt.ssim_fused)
             self.ssim.to(self.device)
 
         self.backproject_depth = {}
@@ -157,20 +262,27 @@ class Trainer:
             h = self.opt.height // (2 ** scale)
             w = self.opt.width // (2 ** scale)
 
-            self.backproject_depth[scale] = BackprojectDepth(self.opt.batch_size, h, w)
+            self.backproject_depth[scale] = BackprojectDepth(h, w)
             self.backproject_depth[scale].to(self.device)
 
-            self.project_3d[scale] = Project3D(self.opt.batch_size, h, w)
+            self.project_3d[scale] = Project3D(h, w)
             self.project_3d[scale].to(self.device)
 
+        self.warp_images = warp_images
+        if self.opt.compile:
+            self.compile()
+
+        self.crop_masks = {}
         self.depth_metric_names = [
             "de/abs_rel", "de/sq_rel", "de/rms", "de/log_rms", "de/log10","da/a1", "da/a2", "da/a3"]
 
-        print("Using split:\n  ", self.opt.split)
-        print("There are {:d} training items and {:d} validation items\n".format(
-            len(train_dataset), len(val_dataset)))
+        if self.is_main:
+            print("Using split:\n  ", self.opt.split)
+            print("There are {:d} training items and {:d} validation items\n".format(
+                len(train_dataset), len(val_dataset)))
 
-        self.save_opts()
+            self.save_opts()
+            self.checkpoint_writer = CheckpointWriter()
 
     def set_train(self):
         """Convert all models to training mode
@@ -189,45 +301,82 @@ class Trainer:
         """
         self.epoch = 0
         self.step = 0
-        self.val()
+        if self.training_state is not None:
+            self.restore_training_state()
+        else:
+            self.val()
         self.start_time = time.time()
-        for self.epoch in range(self.opt.num_epochs):
+        for self.epoch in range(self.epoch, self.opt.num_epochs):
             torch.cuda.empty_cache()
+            self.train_loader.sampler.set_epoch(self.epoch)
             self.run_epoch()
-            if (self.epoch + 1) % self.opt.save_frequency == 0:
+            if (self.epoch + 1) % self.opt.save_frequency == 0 and self.is_main:
                 self.save_model()
+            if self.opt.checkpoint_frequency > 0:
+                self.train_loader.sampler.set_epoch(self.epoch + 1)
+                self.save_training_state(self.epoch + 1, 0)
+
+        if self.is_main:
+            self.checkpoint_writer.wait()
+            self.summary_logger.wait()
 
     def run_epoch(self):
         """Run a single epoch of training and validation
         """
 
-        print("Training")
+        if self.is_main:
+            print("Training")
         self.set_train()
 
+        # the running loss stays on the device until it is logged
         run_step = 0
-        loss_sum = 0.0
+        loss_sum = torch.zeros((), device=self.device)
+
+        num_micro_batches = self.opt.accumulation_steps
+        micro_batches = iter(self.train_loader)
 
-        for batch_idx, inputs in enumerate(self.train_loader):
+        # a resumed epoch starts from the first unused batch
+        first_batch = self.train_loader.sampler.offset // self.opt.batch_size
+
+        for batch_idx in range(first_batch, first_batch + len(self.train_loader) // num_micro_batches):
 
             before_op_time = time.time()
 
-            outputs, losses = self.process_batch(inputs)
+            # log less frequently after the first 2000 steps to save time & disk space
+            early_phase = batch_idx % self.opt.log_frequency == 0 and self.step < 2000
+            late_phase = self.step % 2000 == 0
+
+            # all the micro-batches of a step run the same number of refinement stages
+            num_stages = self.get_num_stages()
 
             self.model_optimizer.zero_grad()
-            losses["loss"].backward()
-            self.model_optimizer.step()
+            loss = 0
+            for micro_idx in range(num_micro_batches):
+                inputs = next(micro_batches)
+                last_micro_batch = micro_idx == num_micro_batches - 1
+
+                # the gradients are only synchronised across processes on the last micro-batch
+                with self.no_sync(not last_micro_batch):
+                    with self.autocast():
+                        outputs, losses = self.process_batch(
+                            inputs, num_stages, keep_outputs=(early_phase or late_phase) and last_micro_batch)
+                    self.scaler.scale(losses["loss"] / num_micro_batches).backward()
+
+                loss += losses["loss"].detach() / num_micro_batches
+
+            self.scaler.step(self.model_optimizer)
+            self.scaler.update()
 
             duration = time.time() - before_op_time
 
-            run_step += 1
-            loss_sum += losses["loss"].cpu().data
+            # the other losses are logged for the last micro-batch
+            losses["loss"] = loss
 
-            # log less frequently after the first 2000 steps to save time & disk space
-            early_phase = batch_idx % self.opt.log_frequency == 0 and self.step < 2000
-            late_phase = self.step % 2000 == 0
+            run_step += 1
+            loss_sum += losses["loss"]
 
-            if early_phase or late_phase:
-                self.log_time(batch_idx, duration, loss_sum/run_step)
+            if (early_phase or late_phase) and self.is_main:
+                self.log_time(batch_idx, duration, (loss_sum / run_step).item())
 
                 if "depth_gt" in inputs:
                     self.compute_depth_losses(inputs, outputs, losses)
@@ -235,277 +384,253 @@ class Trainer:
                 self.log("train", inputs, outputs, losses)
             self.step += 1
 
+            if self.opt.checkpoint_frequency > 0 and self.step % self.opt.checkpoint_frequency == 0:
+                self.save_training_state(self.epoch, (batch_idx + 1 - first_batch) * self.opt.batch_size)
+
         self.model_lr_scheduler.step()
 
         self.val()
 
 
-    def process_batch(self, inputs):
+    def compile(self):
+        """Compile the networks, the projection, the warping and the reprojection loss
+        The control flow around them (stages, dictionaries) stays in Python. Each graph is
+        compiled on its first call and recompiled when the input shapes change, e.g. for the
+        last validation batch.
+        """
+        if self.opt.compile_cache_dir is not None:
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = self.opt.compile_cache_dir
+
+        for model in self.models.values():
+            if self.distributed:
+                model = model.module
+            model.compile()
+
+        for scale in self.opt.scales:
+            self.project_3d[scale].project = torch.compile(self.project_3d[scale].project)
+        self.warp_images = torch.compile(warp_images)
+        self.compute_reprojection_loss = torch.compile(self.compute_reprojection_loss)
+
+    def no_sync(self, enabled=True):
+        """Context disabling the gradient synchronisation of the distributed models
+        """
+        stack = contextlib.ExitStack()
+        if self.distributed and enabled:
+            for model in self.models.values():
+                stack.enter_context(model.no_sync())
+        return stack
+
+    def autocast(self):
+        """Autocast context of the mixed-precision mode, a no-op unless --amp is set
+        """
+        return torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def process_batch(self, inputs, num_stages=None, keep_outputs=True):
         """Pass a minibatch through the network and generate images and losses."""
         """Pass a minibatch through the network and generate images and losses
+        Unless keep_outputs is set, the warped images and the per-pixel reprojection losses, which
+        autograd does not hold, are released as soon as the losses are computed.
         """
+        if num_stages is None:
+            num_stages = self.opt.num_refinement_stages
+
+        memory = MemoryMeter(self.device, enabled=self.opt.log_memory)
 
         for key, ipt in inputs.items():
             inputs[key] = ipt.to(self.device)
 
         norm_pix_coords = [inputs[("norm_pix_coords", s)] for s in self.opt.scales]
 
-       
-         # Only feed the image with frame_id 0 through the depth encoder
-        features = self.models["encoder"](inputs[("color_aug", 0, 0)])
-        # ScaleNetwork to extract the depth factor
+        with memory:
+            # Only feed the image with frame_id 0 through the depth encoder
+            features = self.models["encoder"](inputs[("color_aug", 0, 0)])
+            # ScaleNetwork to extract the depth factor
 
-        outputs = self.models["depth"](features, norm_pix_coords)
+            outputs = self.models["depth"](features, norm_pix_coords)
 
-        outputs.update(self.predict_poses_ori(inputs))
-        self.generate_images_pred_ori(inputs, outputs)
+            # the max depths are shared by all the refinement stages
+            outputs.update(self.predict_max_depths(inputs, features))
 
-        outputs.update(self.predict_poses_second(inputs, outputs))
-        self.generate_images_pred_second(inputs, outputs)
+            self.generate_depths(inputs, outputs, num_stages)
+            memory.record("depth")
 
-        outputs.update(self.predict_poses_third(inputs, outputs))
-        self.generate_images_pred_third(inputs, outputs)
+            for k in range(num_stages):
+                self.predict_poses(inputs, outputs, k)
+                self.generate_images_pred(inputs, outputs, k, last_stage=(k == num_stages - 1))
+                memory.record(self.stages[k]["name"])
 
-        losses = self.compute_losses(inputs, outputs)
+            losses = self.compute_losses(inputs, outputs, num_stages, keep_outputs)
+            memory.record("losses")
+
+        losses.update(memory.report)
 
         return outputs, losses
 
 
-    def predict_poses_ori(self, inputs):
-        """Predict poses between input frames for monocular sequences.
+    def predict_max_depths(self, inputs, features):
+        """Predict the max depth of every input frame with the ScaleNetwork, once per minibatch.
+        The max depths only rescale the disparities used for warping, where they are detached,
+        so they are predicted without building a graph.
         """
         outputs = {}
-        if self.num_pose_frames == 2:
-            # In this setting, we compute the pose to each source frame via a
-            # separate forward pass through the pose network.
-
-            # select what features the pose network takes as input
-            pose_feats = {f_i: inputs["color_aug", f_i, 0] for f_i in self.opt.frame_ids}
-
-            half_source_frames = len(self.opt.frame_ids[1:]) // 2
-
-            negative_half = self.opt.frame_ids[:1] + self.opt.frame_ids[half_source_frames:0:-1]
-
-            for i in range(half_source_frames):
-                pose_inputs = [pose_feats[negative_half[i + 1]], pose_feats[negative_half[i]]]
-                pose_inputs = [self.models["pose_encoder"](torch.cat(pose_inputs, 1))]
-                axisangle, translation = self.models["pose_rec"](pose_inputs)
-
-                outputs[("axisangle", negative_half[i + 1], negative_half[i])] = axisangle
-                outputs[("translation", negative_half[i + 1], negative_half[i])] = translation
-
-                # Invert the matrix if the frame id is negative
-                if i == 0:
-                    outputs[("cam_T_cam_ori", 0, negative_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=True)
-                else:
-                    outputs[("cam_T_cam_ori", negative_half[i], negative_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=True)
-                    outputs[("cam_T_cam_ori", 0, negative_half[i + 1])] = \
-                        outputs[("cam_T_cam_ori", 0, negative_half[i])] @ \
-                        outputs[("cam_T_cam_ori", negative_half[i], negative_half[i + 1])]
+        with torch.no_grad():
+            # all the source frames go through the encoder in a single batch, and the scale
+            # network sees the target and source frames together
+            source_ids = self.opt.frame_ids[1:]
+            source_color_aug = torch.cat([inputs[("color_aug", i, 0)] for i in source_ids])
+            source_features = self.models["encoder"](source_color_aug)
+            all_features = [torch.cat([f, sf]) for f, sf in zip(features, source_features)]
+            max_depths = self.predict_max_depth(all_features)
+
+            all_max_depths = torch.split(max_depths, features[0].shape[0])
+            for frame_id, max_depth in zip(self.opt.frame_ids, all_max_depths):
+                outputs[("max_depth", frame_id)] = max_depth
 
-            positive_half = self.opt.frame_ids[:1] + self.opt.frame_ids[half_source_frames + 1:]
-
-            for i in range(half_source_frames):
-                pose_inputs = [pose_feats[positive_half[i]], pose_feats[positive_half[i + 1]]]
-                pose_inputs = [self.models["pose_encoder"](torch.cat(pose_inputs, 1))]
-                axisangle, translation = self.models["pose_rec"](pose_inputs)
-
-                outputs[("axisangle", positive_half[i], positive_half[i + 1])] = axisangle
-                outputs[("translation", positive_half[i], positive_half[i + 1])] = translation
-
-                if i == 0:
-                    outputs[("cam_T_cam_ori", 0, positive_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=False)
-                else:
-                    outputs[("cam_T_cam_ori", positive_half[i], positive_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=False)
-                    outputs[("cam_T_cam_ori", 0, positive_half[i + 1])] = \
-                        outputs[("cam_T_cam_ori", 0, positive_half[i])] @ \
-                        outputs[("cam_T_cam_ori", positive_half[i], positive_half[i + 1])]
-
-        else:
-            # Here we input all frames to the pose net (and predict all poses) together
-            pose_inputs = torch.cat(
-                [inputs[("color_aug", i, 0)] for i in self.opt.frame_ids], 1)
+        return outputs
 
-            pose_inputs = [self.models["pose_encoder"](pose_inputs)]
+    def predict_max_depth(self, features):
+        """Predict one max depth per sample from the encoder features with the ScaleNetwork
+        """
+        depth_factors = self.models["scalenet"](features)
+        regression = self.models["regression"]
+        if self.distributed:
+            regression = regression.module
+        scale_predictions = [head(factor) for head, factor in zip(regression, depth_factors)]
+        return torch.mean(torch.stack(scale_predictions), dim=0)
+
+    def predict_depth(self, inputs):
+        """Predict the depth of the target frame only, as evaluate_nyu_depth.py does
+        This is the depth-only validation path, no pose network runs and no loss is computed.
+        """
+        for key, ipt in inputs.items():
+            inputs[key] = ipt.to(self.device)
 
-            axisangle, translation = self.models["pose"](pose_inputs)
+        norm_pix_coords = [inputs[("norm_pix_coords", s)] for s in self.opt.scales]
+        features = self.models["encoder"](inputs[("color_aug", 0, 0)])
+        outputs = self.models["depth"](features, norm_pix_coords)
 
-            for i, f_i in enumerate(self.opt.frame_ids[1:]):
-                outputs[("axisangle", 0, f_i)] = axisangle[:, i:i + 1]
-                outputs[("translation", 0, f_i)] = translation[:, i:i + 1]
-                outputs[("cam_T_cam_ori", 0, f_i)] = transformation_from_parameters(
-                    axisangle[:, i], translation[:, i])
+        max_depth = self.predict_max_depth(features)
+        for scale in self.opt.scales:
+            _, outputs[("depth_ori", 0, scale)] = disp_to_depth(
+                outputs[("disp", scale)], self.opt.min_depth, max_depth)
 
         return outputs
 
-    def predict_poses_second(self, inputs, outputs):
-        """Predict poses between input frames for monocular sequences.
+    def predict_poses_pairs(self, pose_feats, pose_decoder, stage):
+        """Predict the poses between all pairs of neighbouring frames with a single forward
+        pass through the pose network, and chain them into poses relative to frame 0.
         """
+        outputs = {}
+        half_source_frames = len(self.opt.frame_ids[1:]) // 2
 
-        if self.num_pose_frames == 2:
-       
-
-            # select what features the pose network takes as input
-            pose_feats = {f_i: outputs[("color_aug_ori", f_i, 0)]  for f_i in self.opt.frame_ids[1:]}
-            pose_feats[0] = inputs[("color_aug", 0, 0)]
+        negative_half = self.opt.frame_ids[:1] + self.opt.frame_ids[half_source_frames:0:-1]
+        positive_half = self.opt.frame_ids[:1] + self.opt.frame_ids[half_source_frames + 1:]
 
-            half_source_frames = len(self.opt.frame_ids[1:]) // 2  
+        negative_pairs = [(negative_half[i + 1], negative_half[i]) for i in range(half_source_frames)]
+        positive_pairs = [(positive_half[i], positive_half[i + 1]) for i in range(half_source_frames)]
+        pairs = negative_pairs + positive_pairs
 
-            negative_half = self.opt.frame_ids[:1] + self.opt.frame_ids[half_source_frames:0:-1]
+        # all the pairs are stacked along the batch dimension
+        pose_inputs = torch.cat([torch.cat([pose_feats[f_i], pose_feats[f_j]], 1) for f_i, f_j in pairs])
+        pose_inputs = [self.models["pose_encoder"](pose_inputs)]
+        axisangle, translation = pose_decoder(pose_inputs)
 
-            for i in range(half_source_frames):
-                pose_inputs = [pose_feats[negative_half[i + 1]], pose_feats[negative_half[i]]] 
-                pose_inputs = [self.models["pose_encoder"](torch.cat(pose_inputs, 1))]
-                axisangle, translation = self.models["pose"](pose_inputs)
+        for pair, pair_axisangle, pair_translation in zip(
+                pairs, axisangle.chunk(len(pairs)), translation.chunk(len(pairs))):
+            outputs[("axisangle",) + pair] = pair_axisangle
+            outputs[("translation",) + pair] = pair_translation
 
-                outputs[("axisangle", negative_half[i + 1], negative_half[i])] = axisangle
-                outputs[("translation", negative_half[i + 1], negative_half[i])] = translation
+        if half_source_frames == 0:
+            return outputs
 
-                # Invert the matrix if the frame id is negative
-                if i == 0:
-                    outputs[("cam_T_cam_second", 0, negative_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=True)
-                else:
-                    outputs[("cam_T_cam_second", negative_half[i], negative_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=True)
-                    outputs[("cam_T_cam_second", 0, negative_half[i + 1])] = \
-                        outputs[("cam_T_cam_second", 0, negative_half[i])] @ \
-                        outputs[("cam_T_cam_second", negative_half[i], negative_half[i + 1])]
+        # 2 x half_source_frames x B poses, invert the matrix if the frame id is negative
+        batch_size = pose_feats[0].shape[0]
+        invert = torch.tensor([True, False], device=axisangle.device).view(2, 1, 1)
+        T = pose_from_axisangle(axisangle[:, 0, 0].view(2, half_source_frames, batch_size, 3),
+                                translation[:, 0, 0].view(2, half_source_frames, batch_size, 3), invert)
 
-            positive_half = self.opt.frame_ids[:1] + self.opt.frame_ids[half_source_frames + 1:]
+        # both halves are chained at once
+        cam_T_cam = accumulate_poses(T, dim=1)
 
+        halves = [negative_half, positive_half]
+        for k in range(2):
             for i in range(half_source_frames):
-                pose_inputs = [pose_feats[positive_half[i]], pose_feats[positive_half[i + 1]]]
-                pose_inputs = [self.models["pose_encoder"](torch.cat(pose_inputs, 1))]
-                axisangle, translation = self.models["pose"](pose_inputs)
-
-                outputs[("axisangle", positive_half[i], positive_half[i + 1])] = axisangle
-                outputs[("translation", positive_half[i], positive_half[i + 1])] = translation
-
-                if i == 0:
-                    outputs[("cam_T_cam_second", 0, positive_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=False)
-                else:
-                    outputs[("cam_T_cam_second", positive_half[i], positive_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=False)
-                    outputs[("cam_T_cam_second", 0, positive_half[i + 1])] = \
-                        outputs[("cam_T_cam_second", 0, positive_half[i])] @ \
-                        outputs[("cam_T_cam_second", positive_half[i], positive_half[i + 1])]
-
-        else:
-            # Here we input all frames to the pose net (and predict all poses) together
-            pose_inputs_ref = torch.cat(
-                [outputs[("color_aug_rot_trans", i, 0)] for i in self.opt.frame_ids[1:]], 1)
-            pose_inputs = torch.cat((inputs[("color_aug", 0, 0)], pose_inputs_ref), 1)
-
-            pose_inputs = [self.models["pose_encoder"](pose_inputs)]
-
-            axisangle, translation = self.models["pose"](pose_inputs)
-
-            for i, f_i in enumerate(self.opt.frame_ids[1:]):
-                outputs[("axisangle", 0, f_i)] = axisangle[:, i:i + 1]#
-                outputs[("translation", 0, f_i)] = translation[:, i:i + 1]
-                outputs[("cam_T_cam_second", 0, f_i)] = transformation_from_parameters(
-                    axisangle[:, i], translation[:, i])
+                if i > 0:
+                    outputs[("cam_T_cam_" + stage, halves[k][i], halves[k][i + 1])] = T[k, i]
+                outputs[("cam_T_cam_" + stage, 0, halves[k][i + 1])] = cam_T_cam[k, i]
 
         return outputs
 
-    def predict_poses_third(self, inputs, outputs):
+    def get_num_stages(self):
+        """Number of refinement stages to run at the current training step
+        """
+        if self.epoch < self.opt.refinement_start_epoch or self.step % self.opt.refinement_frequency != 0:
+            return 1
+        return self.opt.num_refinement_stages
+
+    def predict_poses(self, inputs, outputs, k):
         """Predict poses between input frames for monocular sequences.
+        The first stage looks at the input frames, the following ones at the source frames
+        warped by the previous stage.
         """
-       
-        if self.num_pose_frames == 2:
-            # In this setting, we compute the pose to each source frame via a
-            # separate forward pass through the pose network.
+        stage = self.stages[k]
 
-            # select what features the pose network takes as input
-            pose_feats = {f_i: outputs[("color_aug", f_i, 0)]  for f_i in self.opt.frame_ids[1:]}
+        # select what features the pose network takes as input
+        if k == 0:
+            pose_feats = {f_i: inputs[("color_aug", f_i, 0)] for f_i in self.opt.frame_ids}
+        else:
+            pose_feats = {f_i: outputs[(self.stages[k - 1]["color_aug"], f_i, 0)] for f_i in self.opt.frame_ids[1:]}
             pose_feats[0] = inputs[("color_aug", 0, 0)]
 
-            half_source_frames = len(self.opt.frame_ids[1:]) // 2
-
-            negative_half = self.opt.frame_ids[:1] + self.opt.frame_ids[half_source_frames:0:-1]
-
-            for i in range(half_source_frames):
-                pose_inputs = [pose_feats[negative_half[i + 1]], pose_feats[negative_half[i]]]
-                pose_inputs = [self.models["pose_encoder"](torch.cat(pose_inputs, 1))]
-                axisangle, translation = self.models["pose_third"](pose_inputs)
-
-                outputs[("axisangle", negative_half[i + 1], negative_half[i])] = axisangle
-                outputs[("translation", negative_half[i + 1], negative_half[i])] = translation
-
-                # Invert the matrix if the frame id is negative
-                if i == 0:
-                    outputs[("cam_T_cam_third", 0, negative_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=True)
-                else:
-                    outputs[("cam_T_cam_third", negative_half[i], negative_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=True)
-                    outputs[("cam_T_cam_third", 0, negative_half[i + 1])] = \
-                        outputs[("cam_T_cam_third", 0, negative_half[i])] @ \
-                        outputs[("cam_T_cam_third", negative_half[i], negative_half[i + 1])]
-
-            positive_half = self.opt.frame_ids[:1] + self.opt.frame_ids[half_source_frames + 1:]
-
-            for i in range(half_source_frames):
-                pose_inputs = [pose_feats[positive_half[i]], pose_feats[positive_half[i + 1]]]
-                pose_inputs = [self.models["pose_encoder"](torch.cat(pose_inputs, 1))]
-                axisangle, translation = self.models["pose_third"](pose_inputs)
-
-                outputs[("axisangle", positive_half[i], positive_half[i + 1])] = axisangle
-                outputs[("translation", positive_half[i], positive_half[i + 1])] = translation
-
-                if i == 0:
-                    outputs[("cam_T_cam_third", 0, positive_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=False)
-                else:
-                    outputs[("cam_T_cam_third", positive_half[i], positive_half[i + 1])] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=False)
-                    outputs[("cam_T_cam_third", 0, positive_half[i + 1])] = \
-                        outputs[("cam_T_cam_third", 0, positive_half[i])] @ \
-                        outputs[("cam_T_cam_third", positive_half[i], positive_half[i + 1])]
+        if self.num_pose_frames == 2:
+            # In this setting, all the pairs of neighbouring frames go through
+            # the pose network in a single forward pass.
+            outputs.update(self.predict_poses_pairs(pose_feats, self.models[stage["pose"]], stage["name"]))
 
         else:
             # Here we input all frames to the pose net (and predict all poses) together
-            pose_inputs = torch.cat(
-                [inputs[("color_aug", i, 0)] for i in self.opt.frame_ids], 1)
+            pose_inputs = torch.cat([pose_feats[i] for i in self.opt.frame_ids], 1)
 
             pose_inputs = [self.models["pose_encoder"](pose_inputs)]
 
-            axisangle, translation = self.models["pose"](pose_inputs)
+            axisangle, translation = self.models[stage["pose"]](pose_inputs)
 
             for i, f_i in enumerate(self.opt.frame_ids[1:]):
                 outputs[("axisangle", 0, f_i)] = axisangle[:, i:i + 1]
                 outputs[("translation", 0, f_i)] = translation[:, i:i + 1]
-                outputs[("cam_T_cam_third", 0, f_i)] = transformation_from_parameters(
+                outputs[("cam_T_cam_" + stage["name"], 0, f_i)] = transformation_from_parameters(
                     axisangle[:, i], translation[:, i])
 
-        return outputs 
-
     def val(self):
-        """Validate the model on the whole validation set"""
+        """Validate the model on the validation set, or on a fixed subset of it (see --val_samples)
+        With --val_mode depth, only the target depth is predicted, in evaluation mode, and only
+        the depth metrics are computed.
+        """
+        depth_only = self.opt.val_mode == "depth"
+        if depth_only:
+            self.set_eval()
+
         run_step = 0
-        losses_sum = {"loss": 0.0}
-        losses_avg = {"loss": 0.0}
-
-        for s in self.opt.scales:
-            losses_sum["loss/" + str(s)] = 0.0
-            losses_avg["loss/" + str(s)] = 0.0
-            losses_sum["smooth_loss/" + str(s)] = 0.0
-            losses_avg["smooth_loss/" + str(s)] = 0.0
-            if not self.opt.disable_plane_regularization:
-                losses_sum["plane_loss/" + str(s)] = 0.0
-                losses_avg["plane_loss/" + str(s)] = 0.0
-            if not self.opt.disable_line_regularization:
-                losses_sum["line_loss/" + str(s)] = 0.0
-                losses_avg["line_loss/" + str(s)] = 0.0
-            for frame_id in self.opt.frame_ids[1:]:
-                losses_sum["depth_consistency_loss/{}_{}".format(s, frame_id)] = 0.0
-                losses_avg["depth_consistency_loss/{}_{}".format(s, frame_id)] = 0.0
+        losses_sum = {}
+        losses_avg = {}
+        if not depth_only:
+            losses_sum["loss"] = 0.0
+            losses_avg["loss"] = 0.0
+
+            for s in self.opt.scales:
+                losses_sum["loss/" + str(s)] = 0.0
+                losses_avg["loss/" + str(s)] = 0.0
+                losses_sum["smooth_loss/" + str(s)] = 0.0
+                losses_avg["smooth_loss/" + str(s)] = 0.0
+                if not self.opt.disable_plane_regularization:
+                    losses_sum["plane_loss/" + str(s)] = 0.0
+                    losses_avg["plane_loss/" + str(s)] = 0.0
+                if not self.opt.disable_line_regularization:
+                    losses_sum["line_loss/" + str(s)] = 0.0
+                    losses_avg["line_loss/" + str(s)] = 0.0
+                for frame_id in self.opt.frame_ids[1:]:
+                    losses_sum["depth_consistency_loss/{}_{}".format(s, frame_id)] = 0.0
+                    losses_avg["depth_consistency_loss/{}_{}".format(s, frame_id)] = 0.0
 
         for name in self.depth_metric_names:
             losses_sum[name] = 0.0
@@ -513,8 +638,13 @@ class Trainer:
 
         for batch_idx, inputs in enumerate(self.val_loader):
             run_step += 1
-            with torch.no_grad():
-                outputs, losses = self.process_batch(inputs)
+            with torch.inference_mode(), self.autocast():
+                if depth_only:
+                    outputs, losses = self.predict_depth(inputs), {}
+                else:
+                    # only the last batch is logged
+                    outputs, losses = self.process_batch(
+                        inputs, keep_outputs=(batch_idx == len(self.val_loader) - 1))
                 if "depth_gt" in inputs:
                     self.compute_depth_losses(inputs, outputs, losses)
                 for l, v in losses.items():
@@ -526,7 +656,16 @@ class Trainer:
         for l, v in losses_sum.items():
             losses_avg[l] = losses_sum[l] / run_step
 
-        self.log("val", inputs, outputs, losses_avg)
+        if self.distributed:
+            # average over the shards of all the processes
+            names = sorted(losses_avg)
+            values = torch.stack([torch.as_tensor(losses_avg[l], dtype=torch.float32, device=self.device)
+                                  for l in names])
+            dist.all_reduce(values)
+            losses_avg = dict(zip(names, values / self.world_size))
+
+        if self.is_main:
+            self.log("val", inputs, outputs, losses_avg)
 
         del inputs, outputs, losses, losses_sum, losses_avg
 
@@ -534,246 +673,54 @@ class Trainer:
 
 
 
-    def generate_images_pred_third(self, inputs, outputs):
-        """Generate the warped (reprojected) color images for a minibatch.
-        Generated images are saved into the `outputs` dictionary.
-        """    
-        
-        features = self.models["encoder"](inputs[("color_aug", 0, 0)])
-        depth_factors = self.models["scalenet"](features)
-
-
-        scale_predictions = [head(factor) for head, factor in zip(self.models["regression"], depth_factors)]
-        max_depth = torch.mean(torch.stack(scale_predictions), dim=0)
-
-        for scale in self.opt.scales:
-            disp = outputs[("disp", scale)]
-
-            all_depths = []
-            for i in range(self.opt.batch_size):
-                disp_i = disp[i:i+1]  # (1, H, W)
-                max_depth_i = max_depth[i].item()  
-
-              
-                _, depth_i = disp_to_depth(disp_i, self.opt.min_depth, max_depth_i)
-
-           
-                if not isinstance(depth_i, torch.Tensor):
-                    depth_i = torch.tensor(depth_i)
-
-         
-                depth_i = depth_i.view(1, *depth_i.shape[1:])
-                all_depths.append(depth_i)
-
-            depth = torch.cat(all_depths)
-            outputs[("depth_third", 0, scale)] = depth 
-
-            outputs[("cam_points", 0, scale)] = self.backproject_depth[scale](
-                depth, inputs[("norm_pix_coords", scale)])      
-            all_depths = []
-        
-        for scale in self.opt.scales:
-
-            for i, frame_id in enumerate(self.opt.frame_ids[1:]):
-
-                T = outputs[("cam_T_cam_third", 0, frame_id)]
-
-                pix_coords = self.project_3d[scale](
-                    outputs[("cam_points", 0, scale)], inputs[("K", scale)], T)
-
-                outputs[("sample", frame_id, scale)] = pix_coords.permute(0, 2, 3, 1)
-
-                outputs[("color_new", frame_id, scale)] = F.grid_sample(
-                   outputs[("color", frame_id, scale)],
-                    outputs[("sample", frame_id, scale)],
-                    padding_mode="border", align_corners=True)
-                
-                frame_features = self.models["encoder"](inputs[("color_aug", frame_id, 0)])
-                frame_depth_factors = self.models["scalenet"](frame_features)
-                frame_scale_predictions = [head(factor) for head, factor in zip(self.models["regression"], frame_depth_factors)]
-                frame_max_depth = torch.mean(torch.stack(frame_scale_predictions), dim=0)
-
-                frame_all_depths = []
-                for j in range(self.opt.batch_size):
-                    frame_disp_j = disp[j:j+1]  # (1, H, W)
-                    frame_max_depth_j = frame_max_depth[j].item()  
-
-                    
-                    _, frame_depth_j = disp_to_depth(frame_disp_j, self.opt.min_depth, frame_max_depth_j)
-
-                   
-                    if not isinstance(frame_depth_j, torch.Tensor):
-                        frame_depth_j = torch.tensor(frame_depth_j)
-
-                    
-                    frame_depth_j = frame_depth_j.view(1, *frame_depth_j.shape[1:])
-                    frame_all_depths.append(frame_depth_j)
-
-                frame_depth = torch.cat(frame_all_depths)
-                outputs[("depth_third", frame_id, scale)] = frame_depth
-
-    def generate_images_pred_second(self, inputs, outputs):
-        """Generate the warped (reprojected) color images for a minibatch.
-        Generated images are saved into the `outputs` dictionary.
-        """   
-        features = self.models["encoder"](inputs[("color_aug", 0, 0)])
-        depth_factors = self.models["scalenet"](features)
-
-        
-        scale_predictions = [head(factor) for head, factor in zip(self.models["regression"], depth_factors)]
-        max_depth = torch.mean(torch.stack(scale_predictions), dim=0)
-
+    def generate_depths(self, inputs, outputs, num_stages):
+        """Convert the disparities into depths and backproject the target depths.
+        The depths do not change across the refinement stages, they are shared by all of them.
+        """
         for scale in self.opt.scales:
             disp = outputs[("disp", scale)]
 
-            all_depths = []
-            for i in range(self.opt.batch_size):
-                disp_i = disp[i:i+1]  # (1, H, W)
-                max_depth_i = max_depth[i].item()  
-
-                
-                _, depth_i = disp_to_depth(disp_i, self.opt.min_depth, max_depth_i)
-
-               
-                if not isinstance(depth_i, torch.Tensor):
-                    depth_i = torch.tensor(depth_i)
-
-                
-                depth_i = depth_i.view(1, *depth_i.shape[1:])
-                all_depths.append(depth_i)
-
-            depth = torch.cat(all_depths)
-            outputs[("depth_second", 0, scale)] = depth 
+            for frame_id in self.opt.frame_ids:
+                _, depth = disp_to_depth(disp, self.opt.min_depth, outputs[("max_depth", frame_id)].detach())
+                for stage in self.stages[:num_stages]:
+                    outputs[("depth_" + stage["name"], frame_id, scale)] = depth
 
             outputs[("cam_points", 0, scale)] = self.backproject_depth[scale](
-                depth, inputs[("norm_pix_coords", scale)])      
-            all_depths = []
-        
-        for scale in self.opt.scales:
-
-            for i, frame_id in enumerate(self.opt.frame_ids[1:]):
+                outputs[("depth_ori", 0, scale)], inputs[("norm_pix_coords", scale)])
 
-                T = outputs[("cam_T_cam_second", 0, frame_id)]
-
-                pix_coords = self.project_3d[scale](
-                    outputs[("cam_points", 0, scale)], inputs[("K", scale)], T)
-
-                outputs[("sample", frame_id, scale)] = pix_coords.permute(0, 2, 3, 1)
-
-                outputs[("color", frame_id, scale)] = F.grid_sample(
-                    outputs[("color_ori", frame_id, scale)],
-                    outputs[("sample", frame_id, scale)],
-                    padding_mode="border", align_corners=True)
-
-                outputs[("color_aug", frame_id, scale)] = F.grid_sample(
-                    outputs[("color_aug_ori", frame_id, scale)],
-                    outputs[("sample", frame_id, scale)],
-                    padding_mode="border", align_corners=True)
-                                
-                
-                frame_features = self.models["encoder"](inputs[("color_aug", frame_id, 0)])
-                frame_depth_factors = self.models["scalenet"](frame_features)
-                frame_scale_predictions = [head(factor) for head, factor in zip(self.models["regression"], frame_depth_factors)]
-                frame_max_depth = torch.mean(torch.stack(frame_scale_predictions), dim=0)
-
-                frame_all_depths = []
-                for j in range(self.opt.batch_size):
-                    frame_disp_j = disp[j:j+1]  # (1, H, W)
-                    frame_max_depth_j = frame_max_depth[j].item()  
-
-                    
-                    _, frame_depth_j = disp_to_depth(frame_disp_j, self.opt.min_depth, frame_max_depth_j)
-
-                   
-                    if not isinstance(frame_depth_j, torch.Tensor):
-                        frame_depth_j = torch.tensor(frame_depth_j)
-
-                    
-                    frame_depth_j = frame_depth_j.view(1, *frame_depth_j.shape[1:])
-                    frame_all_depths.append(frame_depth_j)
-
-                frame_depth = torch.cat(frame_all_depths)
-                outputs[("depth_second", frame_id, scale)] = frame_depth
-
-    def generate_images_pred_ori(self, inputs, outputs):
-        """Generate the warped (reprojected) color images for a minibatch.
-        Generated images are saved into the `outputs` dictionary.
+    def generate_images_pred(self, inputs, outputs, k, last_stage=True):
+        """Generate the warped (reprojected) color images of the k-th refinement stage.
+        The first stage warps the input frames, the following ones the frames warped by the
+        previous stage. Generated images are saved into the `outputs` dictionary.
         """
-        features = self.models["encoder"](inputs[("color_aug", 0, 0)])
-        depth_factors = self.models["scalenet"](features)
+        stage = self.stages[k]
+        if k == 0:
+            source, color, color_aug = inputs, "color", "color_aug"
+        else:
+            source, color, color_aug = outputs, self.stages[k - 1]["color"], self.stages[k - 1]["color_aug"]
 
-        
-        scale_predictions = [head(factor) for head, factor in zip(self.models["regression"], depth_factors)]
-        max_depth = torch.mean(torch.stack(scale_predictions), dim=0)
+        source_ids = self.opt.frame_ids[1:]
+        T = torch.stack([outputs[("cam_T_cam_" + stage["name"], 0, f_i)] for f_i in source_ids])
 
         for scale in self.opt.scales:
-            disp = outputs[("disp", scale)]
-
-            all_depths = []
-            for i in range(self.opt.batch_size):
-                disp_i = disp[i:i+1]  # (1, H, W)
-                max_depth_i = max_depth[i].item()  
-
-                
-                _, depth_i = disp_to_depth(disp_i, self.opt.min_depth, max_depth_i)
-
-                
-                if not isinstance(depth_i, torch.Tensor):
-                    depth_i = torch.tensor(depth_i)
-
-                
-                depth_i = depth_i.view(1, *depth_i.shape[1:])
-                all_depths.append(depth_i)
+            # projection matrices of all the source frames at once
+            P = torch.matmul(inputs[("K", scale)], T)[..., :3, :]
 
-            depth = torch.cat(all_depths)
-            outputs[("depth_ori", 0, scale)] = depth 
+            for i, frame_id in enumerate(source_ids):
 
-            outputs[("cam_points", 0, scale)] = self.backproject_depth[scale](
-                depth, inputs[("norm_pix_coords", scale)])      
-            all_depths = []
-            
-              
-            for i, frame_id in enumerate(self.opt.frame_ids[1:]):
-
-                T = outputs[("cam_T_cam_ori", 0, frame_id)]
-
-                pix_coords = self.project_3d[scale](
-                    outputs[("cam_points", 0, scale)], inputs[("K", scale)], T)
+                pix_coords = self.project_3d[scale].project(outputs[("cam_points", 0, scale)], P[i])
 
                 outputs[("sample", frame_id, scale)] = pix_coords.permute(0, 2, 3, 1)
 
-                outputs[("color_ori", frame_id, scale)] = F.grid_sample(
-                    inputs[("color", frame_id, scale)],
-                    outputs[("sample", frame_id, scale)],
-                    padding_mode="border", align_corners=True)
-
-                outputs[("color_aug_ori", frame_id, scale)] = F.grid_sample(
-                    inputs[("color_aug", frame_id, scale)],
-                    outputs[("sample", frame_id, scale)],
-                    padding_mode="border", align_corners=True)
-                
-                frame_features = self.models["encoder"](inputs[("color_aug", frame_id, 0)])
-                frame_depth_factors = self.models["scalenet"](frame_features)
-                frame_scale_predictions = [head(factor) for head, factor in zip(self.models["regression"], frame_depth_factors)]
-                frame_max_depth = torch.mean(torch.stack(frame_scale_predictions), dim=0)
-
-                frame_all_depths = []
-                for j in range(self.opt.batch_size):
-                    frame_disp_j = disp[j:j+1]  # (1, H, W)
-                    frame_max_depth_j = frame_max_depth[j].item()  
-
-                    _, frame_depth_j = disp_to_depth(frame_disp_j, self.opt.min_depth, frame_max_depth_j)
-
-                   
-                    if not isinstance(frame_depth_j, torch.Tensor):
-                        frame_depth_j = torch.tensor(frame_depth_j)
-                    
-                    frame_depth_j = frame_depth_j.view(1, *frame_depth_j.shape[1:])
-                    frame_all_depths.append(frame_depth_j)
-
-                frame_depth = torch.cat(frame_all_depths)
-                outputs[("depth_ori", frame_id, scale)] = frame_depth 
+                images = {stage["color"]: source[(color, frame_id, scale)]}
+                # the next stage estimates its pose from the full resolution augmented images,
+                # they are warped together with the color images
+                if not last_stage and scale == 0:
+                    images[stage["color_aug"]] = source[(color_aug, frame_id, scale)]
 
+                warped = self.warp_images(list(images.values()), outputs[("sample", frame_id, scale)])
+                for key, image in zip(images, warped):
+                    outputs[(key, frame_id, scale)] = image
 
     def compute_reprojection_loss(self, pred, target):
         """Computes reprojection loss between a batch of predicted and target images
@@ -819,9 +766,15 @@ class Trainer:
 
     
 
-    def compute_losses(self, inputs, outputs):
+    def compute_losses(self, inputs, outputs, num_stages=None, keep_outputs=True):
         """Compute the reprojection and smoothness losses for a minibatch
+        Unless keep_outputs is set, the warped images are removed from the outputs once stacked
+        and the per-pixel reprojection losses are not stored.
         """
+        if num_stages is None:
+            num_stages = self.opt.num_refinement_stages
+        stages = self.stages[:num_stages]
+
         losses = {}
         total_loss = 0
 
@@ -833,20 +786,19 @@ class Trainer:
             target = inputs[("color", 0, scale)]
 
             #calculate the multi-reprojection loss
-            for frame_id in self.opt.frame_ids[1:]:
-                pred_ori = outputs[("color_ori", frame_id, scale)]
-                pred = outputs[("color", frame_id, scale)]
-                pred_new = outputs[("color_new", frame_id, scale)]
-                
-                outputs[("reprojection_losses_ori", frame_id, scale)] = self.compute_reprojection_loss(pred_ori, target)
-                loss += 0.25*outputs[("reprojection_losses_ori", frame_id, scale)].mean()
+            #all the predictions of all the stages are evaluated in one batched call
+            keys = [(stage, frame_id) for frame_id in self.opt.frame_ids[1:] for stage in stages]
+            get = outputs.get if keep_outputs else outputs.pop
+            preds = torch.stack([get((stage["color"], frame_id, scale)) for stage, frame_id in keys])
+            targets = target.unsqueeze(0).expand_as(preds)
 
-                outputs[("reprojection_losses_vitual", frame_id, scale)] = self.compute_reprojection_loss(pred, target)
-                loss += outputs[("reprojection_losses_vitual", frame_id, scale)].mean()
-
-                outputs[("reprojection_losses_new", frame_id, scale)] = self.compute_reprojection_loss(pred_new, target)
-                loss += outputs[("reprojection_losses_new", frame_id, scale)].mean()
+            reprojection_losses = self.compute_reprojection_loss(
+                preds.flatten(0, 1), targets.flatten(0, 1)).unflatten(0, preds.shape[:2])
 
+            for (stage, frame_id), reprojection_loss in zip(keys, reprojection_losses):
+                if keep_outputs:
+                    outputs[("reprojection_losses_" + stage["reprojection"], frame_id, scale)] = reprojection_loss
+                loss += stage["weight"] * reprojection_loss.mean()
 
             if self.opt.disable_plane_smoothness:
                 mean_disp = disp.mean(2, True).mean(3, True)
@@ -865,33 +817,31 @@ class Trainer:
             mean_depth = outputs[("depth_ori", 0, scale)].mean(2, True).mean(3)
             norm_point3D = point3D/(mean_depth + 1e-7)
 
-            if not self.opt.disable_plane_regularization:
+            if not self.opt.disable_plane_regularization and not self.opt.disable_line_regularization:
+                plane_loss, line_loss = get_plane_line_loss(
+                    inputs[("plane_keysets", 0, scale)], inputs[("line_keysets", 0, scale)], norm_point3D)
+            elif not self.opt.disable_plane_regularization:
                 plane_loss = get_plane_loss(inputs[("plane_keysets", 0, scale)], norm_point3D)
+            elif not self.opt.disable_line_regularization:
+                line_loss = get_line_loss(inputs[("line_keysets", 0, scale)], norm_point3D)
+
+            if not self.opt.disable_plane_regularization:
                 loss += self.opt.plane_weight * plane_loss
                 losses["plane_loss/{}".format(scale)] = plane_loss
 
             if not self.opt.disable_line_regularization:
-                line_loss = get_line_loss(inputs[("line_keysets", 0, scale)], norm_point3D)
                 loss += self.opt.line_weight * line_loss
                 losses["line_loss/{}".format(scale)] = line_loss
             
-                # calculate the depth consistency loss
-            for frame_id in self.opt.frame_ids[1:]:
-                depth_ori = outputs[("depth_ori", 0, scale)].squeeze(1)  
-                depth_second = outputs[("depth_second", 0, scale)].squeeze(1) 
-                depth_third = outputs[("depth_third", 0, scale)].squeeze(1)  
-                
-                #compute the consistency among synthesized views
-                depth_consistency_loss_ori_second = self.compute_depth_consistency_loss(depth_ori, depth_second)
-                depth_consistency_loss_ori_third = self.compute_depth_consistency_loss(depth_ori, depth_third)
-                depth_consistency_loss_second_third = self.compute_depth_consistency_loss(depth_second, depth_third)
-
-                depth_consistency_loss = (depth_consistency_loss_ori_second +
-                                          depth_consistency_loss_ori_third +
-                                          depth_consistency_loss_second_third) / 3.0
+            # calculate the depth consistency loss among the refinement stages
+            depths = [outputs[("depth_" + stage["name"], 0, scale)].squeeze(1) for stage in stages]
+            depth_pairs = list(itertools.combinations(depths, 2))
+            depth_consistency_loss = sum(
+                self.compute_depth_consistency_loss(depth_a, depth_b) for depth_a, depth_b in depth_pairs)
+            depth_consistency_loss = depth_consistency_loss / max(len(depth_pairs), 1)
 
             loss += self.opt.depth_consistency_weight * depth_consistency_loss
-            losses["depth_consistency_loss/{}_{}".format(scale, frame_id)] = depth_consistency_loss
+            losses["depth_consistency_loss/{}_{}".format(scale, self.opt.frame_ids[-1])] = depth_consistency_loss
             
             losses["loss/{}".format(scale)] = loss
             total_loss += loss
@@ -916,30 +866,38 @@ class Trainer:
         depth_pred = depth_pred.detach()
 
         depth_gt = inputs["depth_gt"]
-        mask = depth_gt > 0
-
-        # garg/eigen crop
-        crop_mask = torch.zeros_like(mask)
-        crop_mask[:, :, self.dataset.default_crop[2]:self.dataset.default_crop[3], \
-        self.dataset.default_crop[0]:self.dataset.default_crop[1]] = 1
-        mask = mask * crop_mask
+        mask = (depth_gt > 0) & self.get_crop_mask(depth_gt)
 
-        depth_gt = depth_gt[mask]
-        depth_pred = depth_pred[mask]
-        depth_pred *= torch.median(depth_gt) / torch.median(depth_pred)
+        # median scaling of each sample, the pixels out of the mask are left out as NaNs
+        batch_size = depth_gt.shape[0]
+        gt_median = torch.where(mask, depth_gt, np.nan).view(batch_size, -1).nanmedian(1).values
+        pred_median = torch.where(mask, depth_pred, np.nan).view(batch_size, -1).nanmedian(1).values
+        depth_pred = depth_pred * (gt_median / pred_median).view(batch_size, 1, 1, 1)
 
         depth_pred = torch.clamp(depth_pred, min=self.dataset.min_depth, max=self.dataset.max_depth)
 
-        depth_errors = compute_depth_errors(depth_gt, depth_pred)
+        depth_errors = compute_depth_errors(depth_gt, depth_pred, mask)
 
+        # the metrics stay on the device until they are logged
         for i, metric in enumerate(self.depth_metric_names):
-            losses[metric] = np.array(depth_errors[i].cpu())
+            losses[metric] = depth_errors[i]
+
+    def get_crop_mask(self, depth_gt):
+        """Garg/Eigen crop mask at the resolution of 'depth_gt', cached per resolution
+        """
+        shape = tuple(depth_gt.shape[2:])
+        if shape not in self.crop_masks:
+            crop_mask = torch.zeros((1, 1) + shape, dtype=torch.bool, device=depth_gt.device)
+            crop_mask[:, :, self.dataset.default_crop[2]:self.dataset.default_crop[3], \
+            self.dataset.default_crop[0]:self.dataset.default_crop[1]] = 1
+            self.crop_masks[shape] = crop_mask
+        return self.crop_masks[shape]
 
 
     def log_time(self, batch_idx, duration, loss):
         """Print a logging statement to the terminal
         """
-        samples_per_sec = self.opt.batch_size / duration
+        samples_per_sec = self.opt.batch_size * self.world_size / duration
         time_sofar = time.time() - self.start_time
         training_time_left = (
             self.num_total_steps / self.step - 1.0) * time_sofar if self.step > 0 else 0
@@ -949,34 +907,40 @@ class Trainer:
                                   sec_to_hm_str(time_sofar), sec_to_hm_str(training_time_left)))
 
     def log(self, mode, inputs, outputs, losses):
-        """Write an event to the tensorboard events file
+        """Hand the losses, and every log_image_frequency logs a few images, to the summary logger
+        The images are detached, normalized and downsampled on the device.
         """
-        writer = self.writers[mode]
-        for l, v in losses.items():
-            writer.add_scalar("{}".format(l), v, self.step)
-
-        for j in range(min(12, self.opt.batch_size)):  # write a maxmimum of four images
-
-            writer.add_image(
-                "gt_depth_0/{}".format(j),
-                normalize_image(inputs["depth_gt"][j]), self.step)
-            writer.add_image(
-                "gt_disp_0/{}".format(j),
-                normalize_image(1/(inputs["depth_gt"][j]+0.01)), self.step)
-                
+        images = {}
+        if self.num_logs[mode] % self.opt.log_image_frequency == 0:
+            n = self.opt.log_images
+
+            if "depth_gt" in inputs:
+                images["gt_depth_0"] = self.summary_image(normalize_image(inputs["depth_gt"][:n]))
+                images["gt_disp_0"] = self.summary_image(normalize_image(1/(inputs["depth_gt"][:n]+0.01)))
+
             for s in self.opt.scales:
+                # the depth-only validation has neither source frames nor warped images
                 for frame_id in self.opt.frame_ids:
-                    writer.add_image(
-                        "color_{}_{}/{}".format(frame_id, s, j),
-                        inputs[("color", frame_id, s)][j].data, self.step)
-                    if s == 0 and frame_id != 0:
-                        writer.add_image(
-                            "color_pred_{}_{}/{}".format(frame_id, s, j),
-                            outputs[("color", frame_id, s)][j].data, self.step)
-
-                writer.add_image(
-                    "disp_{}/{}".format(s, j),
-                    normalize_image(outputs[("disp", s)][j]), self.step)
+                    if ("color", frame_id, s) not in inputs:
+                        continue
+                    images["color_{}_{}".format(frame_id, s)] = self.summary_image(
+                        inputs[("color", frame_id, s)][:n])
+                    if s == 0 and frame_id != 0 and ("color_ori", frame_id, s) in outputs:
+                        images["color_pred_{}_{}".format(frame_id, s)] = self.summary_image(
+                            outputs.get(("color", frame_id, s), outputs[("color_ori", frame_id, s)])[:n])
+
+                images["disp_{}".format(s)] = self.summary_image(normalize_image(outputs[("disp", s)][:n]))
+
+        self.num_logs[mode] += 1
+        self.summary_logger.log(mode, self.step, losses, images)
+
+    def summary_image(self, x):
+        """Downsample a batch of images in [0, 1] by log_image_downscale and convert it to 8 bits
+        """
+        x = x.detach().float()
+        if self.opt.log_image_downscale > 1:
+            x = F.interpolate(x, scale_factor=1 / self.opt.log_image_downscale, mode="area")
+        return (x.clamp(0, 1) * 255).to(torch.uint8)
 
     def save_opts(self):
         """Save options to disk so we know what we ran this experiment with
@@ -991,46 +955,128 @@ class Trainer:
 
     def save_model(self):
         """Save model weights to disk
+        The state dicts are copied to the CPU here and written to a single file in the background.
         """
-        save_folder = os.path.join(self.log_path, "models", "weights_{}".format(self.epoch))
-        if not os.path.exists(save_folder):
-            os.makedirs(save_folder)
+        save_path = os.path.join(self.log_path, "models", "weights_{}.pth".format(self.epoch))
+        self.checkpoint_writer.save(self.snapshot_weights(), save_path)
 
+    def snapshot_weights(self):
+        """Copy the state dicts of all the models and of the optimizer to the CPU
+        """
+        to_save = {}
         for model_name, model in self.models.items():
-            save_path = os.path.join(save_folder, "{}.pth".format(model_name))
-            to_save = model.state_dict()
+            if self.distributed:
+                model = model.module
+            to_save[model_name] = state_to_cpu(model.state_dict())
             if model_name == 'encoder':
                 # save the sizes - these are needed at prediction time
-                to_save['height'] = self.opt.height
-                to_save['width'] = self.opt.width
-            torch.save(to_save, save_path)
+                to_save[model_name]['height'] = self.opt.height
+                to_save[model_name]['width'] = self.opt.width
 
-        save_path = os.path.join(save_folder, "{}.pth".format("adam"))
-        torch.save(self.model_optimizer.state_dict(), save_path)
+        to_save["adam"] = state_to_cpu(self.model_optimizer.state_dict())
+        return to_save
+
+    def save_training_state(self, epoch, num_used):
+        """Save the weights with everything needed to resume training exactly from here: the
+        epoch and step, the scheduler, the loss scaler, and the RNG states and sampler positions
+        of every process, after 'num_used' samples of the current epoch
+        """
+        rank_state = {
+            "sampler": self.train_loader.sampler.state_dict(num_used),
+            "python_rng": random.getstate(),
+            "numpy_rng": self.numpy_rng_state(),
+            "torch_rng": torch.get_rng_state()}
+        if self.device.type == "cuda":
+            rank_state["cuda_rng"] = torch.cuda.get_rng_state(self.device)
+
+        rank_states = [rank_state]
+        if self.distributed:
+            # the states travel as numpy arrays, pickled tensors do not load back from gloo buffers
+            rank_states = [None] * self.world_size
+            dist.all_gather_object(rank_states, map_tensors(rank_state, lambda t: t.numpy()))
+            rank_states = [map_tensors(s, torch.from_numpy, np.ndarray) for s in rank_states]
+
+        if not self.is_main:
+            return
+
+        to_save = self.snapshot_weights()
+        to_save["training_state"] = {
+            "epoch": epoch,
+            "step": self.step,
+            "scheduler": self.model_lr_scheduler.state_dict(),
+            "scaler": self.scaler.state_dict(),
+            "ranks": rank_states}
+
+        save_path = os.path.join(self.log_path, "models", "last.pth")
+        self.checkpoint_writer.save(to_save, save_path)
+
+    def numpy_rng_state(self):
+        """NumPy RNG state, with the key as a tensor so that it loads as plain weights
+        """
+        state = np.random.get_state()
+        return (state[0], torch.from_numpy(state[1].copy())) + tuple(state[2:])
+
+    def load_training_state(self):
+        """Load the weights and the training state saved by save_training_state, if any
+        """
+        load_path = os.path.join(self.log_path, "models", "last.pth")
+        if not os.path.isfile(load_path):
+            print("Cannot find {} so training starts from scratch".format(load_path))
+            return
+
+        print("resuming from {}".format(load_path))
+        checkpoint = torch.load(load_path, map_location="cpu")
+
+        for n in self.models:
+            model_dict = self.models[n].state_dict()
+            self.models[n].load_state_dict({k: v for k, v in checkpoint[n].items() if k in model_dict})
+        self.model_optimizer.load_state_dict(checkpoint["adam"])
+
+        self.training_state = checkpoint["training_state"]
+        self.model_lr_scheduler.load_state_dict(self.training_state["scheduler"])
+        self.scaler.load_state_dict(self.training_state["scaler"])
+
+        assert len(self.training_state["ranks"]) == self.world_size, \
+            "training must resume with the same number of processes"
+
+    def restore_training_state(self):
+        """Restore the position and the RNG states loaded by load_training_state
+        """
+        self.epoch = self.training_state["epoch"]
+        self.step = self.training_state["step"]
+
+        rank_state = self.training_state["ranks"][self.rank]
+        self.train_loader.sampler.load_state_dict(rank_state["sampler"])
+        random.setstate(rank_state["python_rng"])
+        numpy_rng = rank_state["numpy_rng"]
+        np.random.set_state((numpy_rng[0], numpy_rng[1].numpy()) + tuple(numpy_rng[2:]))
+        torch.set_rng_state(rank_state["torch_rng"])
+        if "cuda_rng" in rank_state:
+            torch.cuda.set_rng_state(rank_state["cuda_rng"], self.device)
 
     def load_model(self):
         """Load model(s) from disk
+        Both checkpoint files and folders with one file per model are supported.
         """
         self.opt.load_weights_folder = os.path.expanduser(self.opt.load_weights_folder)
 
-        assert os.path.isdir(self.opt.load_weights_folder), \
-            "Cannot find folder {}".format(self.opt.load_weights_folder)
-        print("loading model from folder {}".format(self.opt.load_weights_folder))
+        assert os.path.exists(self.opt.load_weights_folder), \
+            "Cannot find {}".format(self.opt.load_weights_folder)
+        print("loading model from {}".format(self.opt.load_weights_folder))
+
+        weights = load_weights(self.opt.load_weights_folder, self.opt.models_to_load + ["adam"])
 
         for n in self.opt.models_to_load:
             print("Loading {} weights...".format(n))
-            path = os.path.join(self.opt.load_weights_folder, "{}.pth".format(n))
+            assert n in weights, "Cannot find {} weights".format(n)
             model_dict = self.models[n].state_dict()
-            pretrained_dict = torch.load(path)
-            pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
+            pretrained_dict = {k: v for k, v in weights[n].items() if k in model_dict}
             model_dict.update(pretrained_dict)
             self.models[n].load_state_dict(model_dict)
 
         # loading adam state
-        optimizer_load_path = os.path.join(self.opt.load_weights_folder, "adam.pth")
-        if os.path.isfile(optimizer_load_path):
+        if "adam" in weights:
             print("Loading Adam weights")
-            optimizer_dict = torch.load(optimizer_load_path)
-            self.model_optimizer.load_state_dict(optimizer_dict)
+            self.model_optimizer.load_state_dict(weights["adam"])
         else:
             print("Cannot find Adam weights so Adam is randomly initialized")
@@ -8,6 +8,7 @@ from __future__ import absolute_import, division, print_function
 import os
 import hashlib
 import zipfile
+import torch
 from six.moves import urllib
 
 
@@ -20,11 +21,12 @@ def readlines(filename):
 
 
 def normalize_image(x):
-    """Rescale image pixels to span range [0, 1]
+    """Rescale the pixels of each image of a batch (N, C, H, W) to span range [0, 1]
+    The ranges are computed on the device, without waiting for it.
     """
-    ma = float(x.max().cpu().data)
-    mi = float(x.min().cpu().data)
-    d = ma - mi if ma != mi else 1e5
+    ma = x.amax(dim=(1, 2, 3), keepdim=True)
+    mi = x.amin(dim=(1, 2, 3), keepdim=True)
+    d = torch.where(ma != mi, ma - mi, torch.full_like(ma, 1e5))
     return (x - mi) / d
 
 